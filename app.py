@@ -1,17 +1,47 @@
 import os
-import boto3
 import chainlit as cl
-from chainlit.input_widget import Select, Slider
-from prompt_template import get_template
+from chainlit.input_widget import Select, Slider, TextInput
+from chainlit.server import app as server_app
+from fastapi.responses import JSONResponse
+from prompt_template import get_model_template
 from typing import Optional
 import json
-import traceback
-import logging
+import time
+import asyncio
+import contextvars
+import concurrent.futures
+import app_api
 import app_bedrock
+import app_clients
+import app_logging
+import app_usage
 
 AWS_REGION = os.environ["AWS_REGION"]
 AUTH_ADMIN_USR = os.environ["AUTH_ADMIN_USR"]
 AUTH_ADMIN_PWD = os.environ["AUTH_ADMIN_PWD"]
+CHAT_MAX_CONCURRENCY = int(os.environ.get("CHAT_MAX_CONCURRENCY", "64"))
+
+app_logging.setup_logging()
+logger = app_logging.get_logger("app")
+
+app_clients.start_warm_up()
+app_usage.get_ledger()
+
+# Chat invocations block on boto3; they run here so they do not stall the event loop the API shares
+chat_executor = concurrent.futures.ThreadPoolExecutor(max_workers=CHAT_MAX_CONCURRENCY, thread_name_prefix="chat-invocation")
+
+
+@server_app.get("/ready")
+async def ready():
+    readiness = app_clients.readiness()
+    return JSONResponse(readiness, status_code=200 if readiness["status"] == "ready" else 503)
+
+# Chainlit registers a catch-all route for the frontend; move /ready ahead of it
+server_app.router.routes.insert(0, server_app.router.routes.pop())
+
+# OpenAI-compatible API on the same clients, router and usage ledger as the chat UI
+server_app.mount("/api", app_api.api)
+server_app.router.routes.insert(0, server_app.router.routes.pop())
 
 
 @cl.password_auth_callback
@@ -32,16 +62,8 @@ def auth_callback(username: str, password: str) -> Optional[cl.User]:
 
 @cl.on_chat_start
 async def main():
-    bedrock = boto3.client("bedrock", region_name=AWS_REGION)
-    
-    response = bedrock.list_foundation_models(
-        byOutputModality="TEXT"
-    )
-    
-    model_ids = []
-    for item in response["modelSummaries"]:
-        model_ids.append(item['modelId'])
-        print(item['modelId'])
+    model_ids = app_clients.list_text_model_ids()
+    logger.debug("Listed foundation models", extra={"fields": {"count": len(model_ids), "models": model_ids}})
     
     settings = await cl.ChatSettings(
         [
@@ -53,7 +75,7 @@ async def main():
                 #initial_index=model_ids.index("meta.llama2-13b-chat-v1"), 
                 #initial_index=model_ids.index("amazon.titan-text-express-v1"), 
                 #initial_index=model_ids.index("anthropic.claude-v2"),
-                initial_index=model_ids.index("anthropic.claude-3-sonnet-20240229-v1:0"),
+                initial_index=model_ids.index(app_clients.BEDROCK_DEFAULT_MODEL_ID),
                 
             ),
             Slider(
@@ -88,6 +110,11 @@ async def main():
                 max=4096,
                 step=256,
             ),
+            TextInput(
+                id="StopSequences",
+                label="Stop Sequences (comma separated)",
+                initial="",
+            ),
         ]
     ).send()
     await setup_agent(settings)
@@ -103,7 +130,7 @@ async def setup_agent(settings):
         top_k = int(settings["TopK"]),
         max_tokens_to_sample = int(settings["MaxTokenCount"]),
         system_message = "You are a helpful assistant.",
-        stop_sequences =  []
+        stop_sequences =  [stop_sequence.strip() for stop_sequence in (settings.get("StopSequences") or "").split(",") if stop_sequence.strip()]
     )
 
     model_strategy = app_bedrock.BedrockModelStrategyFactory.create(bedrock_model_id) #BedrockModelStrategy()
@@ -123,59 +150,97 @@ async def setup_agent(settings):
     elif provider == "mistral": # https://docs.aws.amazon.com/bedrock/latest/userguide/model-parameters-mistral.html
         pass #model_strategy = MistralBedrockModelStrategy()
     else:
-        print(f"Unsupported Provider: {provider}")
+        logger.error("Unsupported provider", extra={"fields": {"provider": provider, "model": bedrock_model_id}})
         raise ValueError(f"Error, Unsupported Provider: {provider}")
 
-    prompt_template = get_template(provider)
-    if bedrock_model_id.startswith("anthropic.claude-3"):
-        prompt_template = '{input}'
+    prompt_template = get_model_template(bedrock_model_id)
 
     cl.user_session.set("prompt_template", prompt_template)
     
-    bedrock_runtime = boto3.client('bedrock-runtime', region_name=AWS_REGION)
-    cl.user_session.set("bedrock_runtime", bedrock_runtime)
+    cl.user_session.set("bedrock_invoker", app_clients.get_invoker())
     cl.user_session.set("bedrock_model_id", bedrock_model_id)
     cl.user_session.set("inference_parameters", inference_parameters)
     cl.user_session.set("bedrock_model_strategy", model_strategy)
     
 
+async def usage_report(message: cl.Message):
+    args = message.content.split()
+    window = args[1] if len(args) > 1 and args[1] in app_usage.WINDOWS else "24h"
+    rows = await cl.make_async(app_usage.get_ledger().aggregate)(window)
+    await cl.Message(content=app_usage.format_report(rows, window)).send()
+
+
 @cl.on_message
 async def main(message: cl.Message):
 
+    app_logging.new_correlation_id()
+    start = time.perf_counter()
+
+    user = cl.user_session.get("user")
+    if message.content.startswith("/usage") and user and user.metadata.get("role") == "admin":
+        await usage_report(message)
+        return
+
     prompt_template = cl.user_session.get("prompt_template") 
-    bedrock_runtime = cl.user_session.get("bedrock_runtime")
+    bedrock_invoker = cl.user_session.get("bedrock_invoker")
     bedrock_model_id = cl.user_session.get("bedrock_model_id")
     inference_parameters = cl.user_session.get("inference_parameters")
     bedrock_model_strategy : app_bedrock.BedrockModelStrategy = cl.user_session.get("bedrock_model_strategy")
 
-    prompt = prompt_template.replace("{input}", message.content)
-    prompt = prompt.replace("{history}", "")
+    prompt = prompt_template.replace("{history}", "")
+    prompt = prompt.replace("{input}", message.content)
     #print(prompt)
     #print(inference_parameters)
     request = bedrock_model_strategy.create_request(inference_parameters, prompt)
     #print(request)
-    print(f"{type(request)} {request}")
+    logger.info("Request", extra={"fields": {"model": bedrock_model_id, "request": app_logging.redact(request)}})
 
     msg = cl.Message(content="")
 
     await msg.send()
 
-    try:
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    invocation = app_api.Invocation(bedrock_invoker, bedrock_model_strategy, request, bedrock_model_id, inference_parameters, app_api.QueueSink(loop, queue, forward_raw=True))
+    future = loop.run_in_executor(chat_executor, contextvars.copy_context().run, invocation.run)
+    session_id = cl.user_session.get("id")
+
+    def record(usage : dict):
+        usage = dict(usage or {})
+        if not usage.get("latency_ms"):
+            usage["latency_ms"] = round((time.perf_counter() - start) * 1000)
+        app_usage.get_ledger().record(user.identifier if user else "anonymous", session_id, bedrock_model_id, usage)
+
+    def record_abandoned(done):
+        # Bedrock bills a stream that failed or was stopped after it started
+        usage = None if done.cancelled() or done.exception() else done.result()
+        usage = usage or invocation.partial_usage()
+        if usage is not None:
+            record(usage)
 
-        #response = bedrock_runtime.invoke_model_with_response_stream(modelId = bedrock_model_id, body = json.dumps(request))
-        response = bedrock_model_strategy.send_request(request, bedrock_runtime, bedrock_model_id)
+    try:
 
-        #stream = response["body"]
-        #await bedrock_model_strategy.process_response_stream(stream, msg)
-        await bedrock_model_strategy.process_response(response, msg)
+        while True:
+            token = await queue.get()
+            if token is app_api.END:
+                break
+            await msg.stream_token(token)
+        usage = await future
+        record(usage)
 
     except Exception as e:
-        logging.error(traceback.format_exc())
+        logger.exception("Request failed", extra={"fields": {"model": bedrock_model_id}})
+        if future.done():
+            record_abandoned(future)
         await msg.stream_token(f"{e}")
     finally:
+        if not future.done():
+            # Stopped from the UI: drop the upstream stream so Bedrock stops generating
+            invocation.close()
+            future.add_done_callback(record_abandoned)
         await msg.send()
 
-    print("End")
+    logger.info("End", extra={"fields": {"model": bedrock_model_id, "elapsed_ms": round((time.perf_counter() - start) * 1000)}})
 
 
 class BedrockModelStrategy():
@@ -188,7 +253,6 @@ class BedrockModelStrategy():
         return response
 
     async def process_response_stream(self, stream, msg : cl.Message):
-        print("unknown")
         await msg.stream_token("unknown")
 
 class AnthropicBedrockModelStrategy(BedrockModelStrategy):
@@ -253,7 +317,6 @@ class CohereBedrockModelStrategy(BedrockModelStrategy):
                     if "generations" in object:
                         generations = object["generations"]
                         for generation in generations:
-                            print(generation)
                             await msg.stream_token(generation["text"])
                             if "finish_reason" in generation:
                                 finish_reason = generation["finish_reason"]
@@ -315,14 +378,12 @@ class MetaBedrockModelStrategy(BedrockModelStrategy):
         return request
 
     async def process_response_stream(self, stream, msg : cl.Message):
-        print("meta")
         await msg.stream_token("Meta")
         if stream:
             for event in stream:
                 chunk = event.get("chunk")
                 if chunk:
                     object = json.loads(chunk.get("bytes").decode())
-                    print(object)
                     if "generation" in object:
                         completion = object["generation"]
                         await msg.stream_token(completion)
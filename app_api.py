@@ -0,0 +1,349 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import contextlib
+import contextvars
+import concurrent.futures
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from prompt_template import get_model_template
+import app_bedrock
+import app_clients
+import app_logging
+import app_postprocess
+import app_usage
+
+# Comma separated name:key pairs; the name is the user recorded in the usage ledger.
+# The API rejects every request while this is empty.
+API_KEYS = os.environ.get("API_KEYS", "")
+API_MAX_CONCURRENCY = int(os.environ.get("API_MAX_CONCURRENCY", "64"))
+API_SYSTEM_MESSAGE = "You are a helpful assistant."
+
+logger = app_logging.get_logger("api")
+
+END = object()
+
+
+def parse_api_keys(api_keys : str) -> dict:
+    keys = {}
+    for pair in api_keys.split(","):
+        if ":" in pair:
+            name, key = pair.split(":", 1)
+            keys[key.strip()] = name.strip()
+    return keys
+
+
+class QueueSink(app_bedrock.TokenSink):
+
+    # Strategies run on a worker thread with their own loop; tokens are handed to the
+    # request's loop. Stats lines are dropped unless forward_raw is set (the chat UI
+    # shows them); usage is returned separately.
+    def __init__(self, loop : asyncio.AbstractEventLoop, queue : asyncio.Queue, forward_raw : bool = False):
+        self.loop = loop
+        self.queue = queue
+        self.forward_raw = forward_raw
+
+    async def stream_token(self, token : str):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, token)
+
+    async def stream_raw(self, token : str):
+        if self.forward_raw:
+            await self.stream_token(token)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, END)
+
+
+class Invocation():
+
+    def __init__(self, invoker, model_strategy, request : dict, bedrock_model_id : str, inference_parameters : dict, sink : QueueSink):
+        self.invoker = invoker
+        self.model_strategy = model_strategy
+        self.request = request
+        self.bedrock_model_id = bedrock_model_id
+        self.inference_parameters = inference_parameters
+        self.sink = sink
+        self.response = None
+        self.usage_sink = None
+        self.cancelled = False
+        self.finish_reason = "stop"
+
+    def run(self) -> dict:
+        # Blocking boto3 calls and stream iteration stay off the server's event loop
+        try:
+            self.response = self.invoker.send_request(self.model_strategy, self.request, self.bedrock_model_id)
+            if self.cancelled:
+                self.close()
+                return None
+            return self.with_target(asyncio.run(self.process()))
+        finally:
+            self.sink.close()
+
+    async def process(self) -> dict:
+        pipeline = app_postprocess.StreamPipeline.create(self.inference_parameters)
+        processed = app_postprocess.PostProcessedMessage(self.sink, pipeline)
+        self.usage_sink = app_bedrock.UsageTrackingSink(processed)
+        try:
+            usage = await self.model_strategy.process_response(self.response, self.usage_sink)
+        finally:
+            # Text held back by the pipeline is still delivered when the stream fails
+            await processed.finish()
+        if not pipeline.stopped and usage and usage.get("output_tokens") and usage["output_tokens"] >= (self.inference_parameters.get("max_tokens_to_sample") or 0) > 0:
+            self.finish_reason = "length"
+        return usage
+
+    def with_target(self, usage : dict) -> dict:
+        target = self.response.get("RouteTarget") if self.response is not None else None
+        if usage is None or target is None:
+            return usage
+        return dict(usage, target=target.name, provisioned=target.target is not None)
+
+    def partial_usage(self) -> dict:
+        # What a failed or abandoned stream had reported; None if it never started
+        if self.usage_sink is None:
+            return None
+        return self.with_target(self.usage_sink.partial_usage())
+
+    def close(self):
+        self.cancelled = True
+        if self.response is not None and hasattr(self.response["body"], "close"):
+            self.response["body"].close()
+
+
+def message_text(message) -> str:
+    # content is a string or, in the chat-completions format, a list of typed parts
+    if not isinstance(message, dict):
+        raise HTTPException(status_code=400, detail="Each message must be an object")
+    content = message.get("content")
+    if content is None or isinstance(content, str):
+        return content or ""
+    if isinstance(content, list):
+        texts = []
+        for part in content:
+            if not isinstance(part, dict) or part.get("type") != "text" or not isinstance(part.get("text"), str):
+                raise HTTPException(status_code=400, detail="Only text content parts are supported")
+            texts.append(part["text"])
+        return "".join(texts)
+    raise HTTPException(status_code=400, detail="Message content must be a string or a list of text parts")
+
+
+def build_prompt(bedrock_model_id : str, messages : list):
+    system_message = None
+    history = []
+    for message in messages[:-1]:
+        text = message_text(message)
+        if message.get("role") == "system":
+            system_message = text
+        else:
+            history.append(f"{message.get('role')}: {text}")
+    last = messages[-1]
+    content = message_text(last)
+    if last.get("role") == "system":
+        raise HTTPException(status_code=400, detail="The last message must not be a system message")
+    template = get_model_template(bedrock_model_id)
+    if history and "{history}" not in template:
+        content = "\n".join(history) + "\n\n" + content
+    # {history} first, so a literal "{history}" in the user's input is left alone
+    prompt = template.replace("{history}", "\n".join(history))
+    prompt = prompt.replace("{input}", content)
+    return prompt, system_message
+
+
+def parameter(body : dict, key : str, default, cast):
+    # An explicit null means the default, as with an absent key
+    value = body.get(key)
+    return default if value is None else cast(value)
+
+
+def inference_parameters_from(body : dict, system_message : str) -> dict:
+    stop = body.get("stop") or []
+    stop_sequences = [stop] if isinstance(stop, str) else stop
+    if not isinstance(stop_sequences, list) or not all(isinstance(stop_sequence, str) for stop_sequence in stop_sequences):
+        raise ValueError("stop must be a string or a list of strings")
+    return dict (
+        temperature = parameter(body, "temperature", 0.3, float),
+        top_p = parameter(body, "top_p", 1.0, float),
+        top_k = parameter(body, "top_k", 250, int),
+        max_tokens_to_sample = int(body.get("max_tokens") or 2048),
+        system_message = system_message or API_SYSTEM_MESSAGE,
+        stop_sequences = stop_sequences,
+    )
+
+
+def openai_usage(usage : dict) -> dict:
+    if not usage:
+        return None
+    input_tokens = usage.get("input_tokens") or 0
+    output_tokens = usage.get("output_tokens") or 0
+    return {"prompt_tokens": input_tokens, "completion_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+
+def create_api(invoker=None, ledger=None, api_keys : str = None, max_concurrency : int = API_MAX_CONCURRENCY) -> FastAPI:
+    # invoker and ledger default to the process-wide ones shared with the chat UI
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app : FastAPI):
+        # Lifespan events only reach the top-level app, so this runs when the API is served
+        # on its own (uvicorn app_api:api); mounted under chainlit, app.py has done it
+        app_logging.setup_logging()
+        if invoker is None:
+            app_clients.start_warm_up()
+        yield
+
+    api = FastAPI(title="chainlit-bedrock-llm", lifespan=lifespan)
+    keys = parse_api_keys(API_KEYS if api_keys is None else api_keys)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="api-invocation")
+
+    def get_invoker():
+        return invoker if invoker is not None else app_clients.get_invoker()
+
+    def get_ledger():
+        return ledger if ledger is not None else app_usage.get_ledger()
+
+    def authenticate(authorization : str) -> str:
+        if not authorization or not authorization.startswith("Bearer "):
+            raise HTTPException(status_code=401, detail="Missing bearer token")
+        user = keys.get(authorization[len("Bearer "):].strip())
+        if user is None:
+            raise HTTPException(status_code=401, detail="Invalid API key")
+        return user
+
+    @api.get("/ready")
+    async def ready():
+        readiness = app_clients.readiness() if invoker is None else {"status": "ready"}
+        return JSONResponse(readiness, status_code=200 if readiness["status"] == "ready" else 503)
+
+    @api.get("/v1/models")
+    async def models(authorization : str = Header(None)):
+        authenticate(authorization)
+        model_ids = await asyncio.get_running_loop().run_in_executor(executor, app_clients.list_text_model_ids)
+        return {"object": "list", "data": [{"id": model_id, "object": "model", "owned_by": model_id.split(".")[0]} for model_id in model_ids]}
+
+    @api.post("/v1/chat/completions")
+    async def chat_completions(request : Request, authorization : str = Header(None)):
+        user = authenticate(authorization)
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="The request body must be JSON")
+        if not isinstance(body, dict):
+            raise HTTPException(status_code=400, detail="The request body must be a JSON object")
+        bedrock_model_id = body.get("model")
+        messages = body.get("messages") or []
+        if not isinstance(bedrock_model_id, str) or not bedrock_model_id or not isinstance(messages, list) or not messages:
+            raise HTTPException(status_code=400, detail="model and messages are required")
+        try:
+            model_strategy = app_bedrock.BedrockModelStrategyFactory.create(bedrock_model_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        app_logging.new_correlation_id()
+        prompt, system_message = build_prompt(bedrock_model_id, messages)
+        try:
+            inference_parameters = inference_parameters_from(body, system_message)
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid parameter: {e}")
+        bedrock_request = model_strategy.create_request(inference_parameters, prompt)
+        logger.info("Request", extra={"fields": {"model": bedrock_model_id, "user": user, "stream": bool(body.get("stream")), "request": app_logging.redact(bedrock_request)}})
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        invocation = Invocation(get_invoker(), model_strategy, bedrock_request, bedrock_model_id, inference_parameters, QueueSink(loop, queue))
+        start = time.perf_counter()
+        future = loop.run_in_executor(executor, contextvars.copy_context().run, invocation.run)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def record(usage : dict):
+            usage = dict(usage or {})
+            if not usage.get("latency_ms"):
+                usage["latency_ms"] = round((time.perf_counter() - start) * 1000)
+            get_ledger().record(user, completion_id, bedrock_model_id, usage)
+
+        def record_failed():
+            # Bedrock bills a stream that failed or was abandoned after it started
+            usage = invocation.partial_usage()
+            if usage is not None:
+                record(usage)
+
+        def record_abandoned(done):
+            usage = None if done.cancelled() or done.exception() else done.result()
+            if usage is not None:
+                record(usage)
+            else:
+                record_failed()
+
+        if not body.get("stream"):
+            tokens = []
+            try:
+                while True:
+                    token = await queue.get()
+                    if token is END:
+                        break
+                    tokens.append(token)
+                usage = await future
+            except Exception as e:
+                logger.exception("Request failed", extra={"fields": {"model": bedrock_model_id}})
+                record_failed()
+                raise HTTPException(status_code=502, detail=str(e))
+            finally:
+                if not future.done():
+                    # Client went away before the response was complete
+                    invocation.close()
+                    future.add_done_callback(record_abandoned)
+            record(usage)
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": bedrock_model_id,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": invocation.finish_reason}],
+                "usage": openai_usage(usage),
+            })
+
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        def chunk(delta : dict, finish_reason : str = None) -> str:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": bedrock_model_id,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(payload)}\n\n"
+
+        async def events():
+            try:
+                yield chunk({"role": "assistant"})
+                while True:
+                    token = await queue.get()
+                    if token is END:
+                        break
+                    yield chunk({"content": token})
+                try:
+                    usage = await future
+                except Exception as e:
+                    logger.exception("Request failed", extra={"fields": {"model": bedrock_model_id}})
+                    record_failed()
+                    yield f"data: {json.dumps({'error': {'message': str(e), 'type': type(e).__name__}})}\n\n"
+                    return
+                record(usage)
+                yield chunk({}, invocation.finish_reason)
+                if include_usage:
+                    yield f"data: {json.dumps({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': bedrock_model_id, 'choices': [], 'usage': openai_usage(usage)})}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                if not future.done():
+                    # Client went away: drop the upstream stream so Bedrock stops generating
+                    invocation.close()
+                    future.add_done_callback(record_abandoned)
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    return api
+
+
+api = create_api()
@@ -1,5 +1,46 @@
-import chainlit as cl
 import json
+import app_logging
+import app_postprocess
+
+logger = app_logging.get_logger("bedrock")
+
+class TokenSink():
+
+    # Where strategies stream generated text; cl.Message satisfies this by duck typing.
+    # stream_raw carries output that is not model text (stats lines).
+    async def stream_token(self, token : str):
+        pass
+
+    async def stream_raw(self, token : str):
+        await self.stream_token(token)
+
+class UsageTrackingSink(TokenSink):
+
+    # Keeps what a stream has reported so far, so an invocation cut short (stop sequence,
+    # stream error, client gone) still records what Bedrock billed. Output is only seen
+    # as chunks, which may hold several tokens, so it is not reported as output_tokens.
+    def __init__(self, sink):
+        self.sink = sink
+        self.input_tokens = None
+        self.output_chunks = 0
+
+    async def stream_token(self, token : str):
+        self.output_chunks += 1
+        await self.sink.stream_token(token)
+
+    async def stream_raw(self, token : str):
+        stream_raw = getattr(self.sink, "stream_raw", self.sink.stream_token)
+        await stream_raw(token)
+
+    def partial_usage(self) -> dict:
+        return {
+            "input_tokens": self.input_tokens,
+            "output_tokens": None,
+            "output_chunks": self.output_chunks,
+            "latency_ms": None,
+            "first_byte_latency_ms": None,
+            "truncated": True,
+        }
 
 class BedrockModelStrategy():
 
@@ -10,13 +51,56 @@ class BedrockModelStrategy():
         response = bedrock_runtime.invoke_model_with_response_stream(modelId = bedrock_model_id, body = json.dumps(request))
         return response
 
-    async def process_response(self, response, msg : cl.Message):
+    # Returns the invocation usage (tokens and latencies) when the model reported it, else None
+    async def process_response(self, response, sink : TokenSink):
         stream = response["body"]
-        await self.process_response_stream(stream, msg)
+        tracking_sink = sink if isinstance(sink, UsageTrackingSink) else UsageTrackingSink(sink)
+        try:
+            usage = await self.process_response_stream(stream, tracking_sink)
+        except app_postprocess.StopSequenceReached:
+            # Stop reading so the model stops generating (and billing) tokens nobody will see.
+            # The final invocation metrics never arrive, so report what was seen so far.
+            if hasattr(stream, "close"):
+                stream.close()
+            logger.debug("Stop sequence reached, upstream stream closed")
+            return self.usage_from_headers(response) or tracking_sink.partial_usage()
+        return usage if usage else self.usage_from_headers(response)
+
+    @staticmethod
+    def record_input_tokens(sink : TokenSink, input_tokens : int):
+        if isinstance(sink, UsageTrackingSink):
+            sink.input_tokens = input_tokens
+
+    async def stream_stats(self, sink : TokenSink, stats : str):
+        # Stats are not model output and must bypass post-processing when the sink supports it
+        stream_raw = getattr(sink, "stream_raw", sink.stream_token)
+        await stream_raw(stats)
 
-    async def process_response_stream(self, stream, msg : cl.Message):
-        print("unknown")
-        await msg.stream_token("unknown")
+    async def process_response_stream(self, stream, sink : TokenSink):
+        logger.warning("No response stream handler for strategy", extra={"fields": {"strategy": type(self).__name__}})
+        await sink.stream_token("unknown")
+
+    @staticmethod
+    def usage_from_metrics(invocation_metrics : dict) -> dict:
+        return {
+            "input_tokens": invocation_metrics.get("inputTokenCount"),
+            "output_tokens": invocation_metrics.get("outputTokenCount"),
+            "latency_ms": invocation_metrics.get("invocationLatency"),
+            "first_byte_latency_ms": invocation_metrics.get("firstByteLatency"),
+        }
+
+    @staticmethod
+    def usage_from_headers(response) -> dict:
+        # invoke_model (non streaming) reports usage in the response headers
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+        if "x-amzn-bedrock-input-token-count" not in headers:
+            return None
+        return {
+            "input_tokens": int(headers["x-amzn-bedrock-input-token-count"]),
+            "output_tokens": int(headers.get("x-amzn-bedrock-output-token-count", 0)),
+            "latency_ms": int(headers.get("x-amzn-bedrock-invocation-latency", 0)),
+            "first_byte_latency_ms": None,
+        }
 
 class BedrockModelStrategyFactory():
 
@@ -62,7 +146,8 @@ class AnthropicBedrockModelStrategy(BedrockModelStrategy):
         }
         return request
 
-    async def process_response_stream(self, stream, msg : cl.Message):
+    async def process_response_stream(self, stream, sink : TokenSink):
+        usage = None
         if stream:
             for event in stream:
                 chunk = event.get("chunk")
@@ -72,7 +157,7 @@ class AnthropicBedrockModelStrategy(BedrockModelStrategy):
                     if "completion" in object:
                         completion = object["completion"]
                         #print(completion)
-                        await msg.stream_token(completion)
+                        await sink.stream_token(completion)
                     stop_reason = None
                     if "stop_reason" in object:
                         stop_reason = object["stop_reason"]
@@ -85,7 +170,9 @@ class AnthropicBedrockModelStrategy(BedrockModelStrategy):
                             latency = invocation_metrics["invocationLatency"]
                             lag = invocation_metrics["firstByteLatency"]
                             stats = f"token.in={input_token_count} token.out={output_token_count} latency={latency} lag={lag}"
-                            await msg.stream_token(f"\n\n{stats}")
+                            usage = self.usage_from_metrics(invocation_metrics)
+                            await self.stream_stats(sink, f"\n\n{stats}")
+        return usage
 
 class AnthropicClaude3MsgBedrockModelStrategy(BedrockModelStrategy):
 
@@ -109,19 +196,29 @@ class AnthropicClaude3MsgBedrockModelStrategy(BedrockModelStrategy):
 
     def send_request(self, request:dict, bedrock_runtime, bedrock_model_id:str):
         response = bedrock_runtime.invoke_model(modelId = bedrock_model_id, body = json.dumps(request))
-        print(response)
+        logger.debug("invoke_model", extra={"fields": {"model": bedrock_model_id, "request_id": response.get("ResponseMetadata", {}).get("RequestId")}})
         return response
 
-    async def process_response(self, response, msg : cl.Message):
+    async def process_response(self, response, sink : TokenSink):
         response_body = json.loads(response.get('body').read())
-        print(response_body)
+        logger.debug("invoke_model response", extra={"fields": {"stop_reason": response_body.get("stop_reason"), "usage": response_body.get("usage")}})
         contents = response_body["content"]
-        for content in contents:
-            await msg.stream_token(f"{content['text']}")
+        try:
+            for content in contents:
+                await sink.stream_token(f"{content['text']}")
+        except app_postprocess.StopSequenceReached:
+            pass
         usage = response_body["usage"]
-        await msg.stream_token(f"token.in={usage['input_tokens']},token.out={usage['output_tokens']}")
+        await self.stream_stats(sink, f"token.in={usage['input_tokens']},token.out={usage['output_tokens']}")
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+        return {
+            "input_tokens": usage["input_tokens"],
+            "output_tokens": usage["output_tokens"],
+            "latency_ms": int(headers["x-amzn-bedrock-invocation-latency"]) if "x-amzn-bedrock-invocation-latency" in headers else None,
+            "first_byte_latency_ms": None,
+        }
 
-    async def process_response_stream(self, stream, msg : cl.Message):
+    async def process_response_stream(self, stream, sink : TokenSink):
         pass
 
 class AnthropicClaude3MsgBedrockModelAsyncStrategy(BedrockModelStrategy):
@@ -146,17 +243,18 @@ class AnthropicClaude3MsgBedrockModelAsyncStrategy(BedrockModelStrategy):
 
     def send_request(self, request:dict, bedrock_runtime, bedrock_model_id:str):
         response = bedrock_runtime.invoke_model_with_response_stream(modelId = bedrock_model_id, body = json.dumps(request))
-        print(response)
+        logger.debug("invoke_model_with_response_stream", extra={"fields": {"model": bedrock_model_id, "request_id": response.get("ResponseMetadata", {}).get("RequestId")}})
         return response
 
-    async def process_response_stream(self, stream, msg : cl.Message):
+    async def process_response_stream(self, stream, sink : TokenSink):
+        usage = None
 
         for event in stream:
             chunk = json.loads(event["chunk"]["bytes"])
 
             if chunk['type'] == 'message_start':
                 #print(f"Input Tokens: {chunk['message']['usage']['input_tokens']}")
-                pass
+                self.record_input_tokens(sink, chunk['message'].get('usage', {}).get('input_tokens'))
 
             elif chunk['type'] == 'message_delta':
                 #print(f"\nStop reason: {chunk['delta']['stop_reason']}")
@@ -167,7 +265,7 @@ class AnthropicClaude3MsgBedrockModelAsyncStrategy(BedrockModelStrategy):
             elif chunk['type'] == 'content_block_delta':
                 if chunk['delta']['type'] == 'text_delta':
                     text = chunk['delta']['text']
-                    await msg.stream_token(f"{text}")
+                    await sink.stream_token(f"{text}")
 
             elif chunk['type'] == 'message_stop':
                 invocation_metrics = chunk['amazon-bedrock-invocationMetrics']
@@ -176,7 +274,9 @@ class AnthropicClaude3MsgBedrockModelAsyncStrategy(BedrockModelStrategy):
                 latency = invocation_metrics["invocationLatency"]
                 lag = invocation_metrics["firstByteLatency"]
                 stats = f"token.in={input_token_count} token.out={output_token_count} latency={latency} lag={lag}"
-                await msg.stream_token(f"\n\n{stats}")
+                usage = self.usage_from_metrics(invocation_metrics)
+                await self.stream_stats(sink, f"\n\n{stats}")
+        return usage
 
 class CohereBedrockModelStrategy(BedrockModelStrategy):
 
@@ -192,9 +292,10 @@ class CohereBedrockModelStrategy(BedrockModelStrategy):
         }
         return request
 
-    async def process_response_stream(self, stream, msg : cl.Message):
+    async def process_response_stream(self, stream, sink : TokenSink):
         #print("cohere")
-        #await msg.stream_token("Cohere")
+        #await sink.stream_token("Cohere")
+        usage = None
         if stream:
             for event in stream:
                 chunk = event.get("chunk")
@@ -203,11 +304,15 @@ class CohereBedrockModelStrategy(BedrockModelStrategy):
                     if "generations" in object:
                         generations = object["generations"]
                         for generation in generations:
-                            print(generation)
-                            await msg.stream_token(generation["text"])
+                            if app_logging.should_log_chunk(logger):
+                                logger.debug("chunk", extra={"fields": {"provider": "cohere", "text": app_logging.redact_text(generation.get("text")), "finish_reason": generation.get("finish_reason")}})
+                            await sink.stream_token(generation["text"])
                             if "finish_reason" in generation:
                                 finish_reason = generation["finish_reason"]
-                                await msg.stream_token(f"\nfinish_reason={finish_reason}")
+                                await self.stream_stats(sink, f"\nfinish_reason={finish_reason}")
+                    if "amazon-bedrock-invocationMetrics" in object:
+                        usage = self.usage_from_metrics(object["amazon-bedrock-invocationMetrics"])
+        return usage
 
 
 class TitanBedrockModelStrategy(BedrockModelStrategy):
@@ -225,9 +330,10 @@ class TitanBedrockModelStrategy(BedrockModelStrategy):
         }
         return request
 
-    async def process_response_stream(self, stream, msg : cl.Message):
+    async def process_response_stream(self, stream, sink : TokenSink):
+        usage = None
         #print("titan")
-        #await msg.stream_token("Titan")
+        #await sink.stream_token("Titan")
         if stream:
             for event in stream:
                 chunk = event.get("chunk")
@@ -236,7 +342,7 @@ class TitanBedrockModelStrategy(BedrockModelStrategy):
                     #print(object)
                     if "outputText" in object:
                         completion = object["outputText"]
-                        await msg.stream_token(completion)
+                        await sink.stream_token(completion)
                     if "completionReason" in object:
                         finish_reason = object["completionReason"]
                         if finish_reason:
@@ -248,7 +354,9 @@ class TitanBedrockModelStrategy(BedrockModelStrategy):
                                     latency = invocation_metrics["invocationLatency"]
                                     lag = invocation_metrics["firstByteLatency"]
                                     stats = f"token.in={input_token_count} token.out={output_token_count} latency={latency} lag={lag} finish_reason={finish_reason}"
-                                    await msg.stream_token(f"\n\n{stats}")
+                                    usage = self.usage_from_metrics(invocation_metrics)
+                                    await self.stream_stats(sink, f"\n\n{stats}")
+        return usage
 
 class MetaBedrockModelStrategy(BedrockModelStrategy):
 
@@ -263,18 +371,18 @@ class MetaBedrockModelStrategy(BedrockModelStrategy):
         }
         return request
 
-    async def process_response_stream(self, stream, msg : cl.Message):
-        print("meta")
-        await msg.stream_token("Meta")
+    async def process_response_stream(self, stream, sink : TokenSink):
+        usage = None
         if stream:
             for event in stream:
                 chunk = event.get("chunk")
                 if chunk:
                     object = json.loads(chunk.get("bytes").decode())
-                    print(object)
+                    if app_logging.should_log_chunk(logger):
+                        logger.debug("chunk", extra={"fields": {"provider": "meta", "text": app_logging.redact_text(object.get("generation")), "stop_reason": object.get("stop_reason")}})
                     if "generation" in object:
                         completion = object["generation"]
-                        await msg.stream_token(completion)
+                        await sink.stream_token(completion)
                     if "stop_reason" in object:
                         finish_reason = object["stop_reason"]
                         if finish_reason:
@@ -286,7 +394,9 @@ class MetaBedrockModelStrategy(BedrockModelStrategy):
                                     latency = invocation_metrics["invocationLatency"]
                                     lag = invocation_metrics["firstByteLatency"]
                                     stats = f"token.in={input_token_count} token.out={output_token_count} latency={latency} lag={lag} finish_reason={finish_reason}"
-                                    await msg.stream_token(f"\n\n{stats}")
+                                    usage = self.usage_from_metrics(invocation_metrics)
+                                    await self.stream_stats(sink, f"\n\n{stats}")
+        return usage
 
 
 
@@ -307,14 +417,14 @@ class AI21BedrockModelStrategy(BedrockModelStrategy):
         response = bedrock_runtime.invoke_model(modelId = bedrock_model_id, body = json.dumps(request))
         return response
     
-    async def process_response_stream(self, stream, msg : cl.Message):
-        #await msg.stream_token(f"AI21")
+    async def process_response_stream(self, stream, sink : TokenSink):
+        #await sink.stream_token(f"AI21")
         
         object = json.loads(stream.read())
         #print(object)
         #print(object.get('completions')[0].get('data').get('text'))
         text = object.get('completions')[0].get('data').get('text')
-        await msg.stream_token(f"{text}")
+        await sink.stream_token(f"{text}")
 
 
 class MistralBedrockModelStrategy(BedrockModelStrategy):
@@ -330,7 +440,8 @@ class MistralBedrockModelStrategy(BedrockModelStrategy):
         }
         return request
 
-    async def process_response_stream(self, stream, msg : cl.Message):
+    async def process_response_stream(self, stream, sink : TokenSink):
+        usage = None
         if stream:
             for event in stream:
                 #print(f"Event: {event}")
@@ -341,7 +452,7 @@ class MistralBedrockModelStrategy(BedrockModelStrategy):
                     if "outputs" in object:
                         outputs = object["outputs"]
                         for index, output in enumerate(outputs):
-                            await msg.stream_token(output["text"])
+                            await sink.stream_token(output["text"])
 
                             stop_reason = None
                             if "stop_reason" in output:
@@ -355,4 +466,7 @@ class MistralBedrockModelStrategy(BedrockModelStrategy):
                                     latency = invocation_metrics["invocationLatency"]
                                     lag = invocation_metrics["firstByteLatency"]
                                     stats = f"token.in={input_token_count} token.out={output_token_count} latency={latency} lag={lag}"
-                                    await msg.stream_token(f"\n\n{stats}")
+                                    usage = self.usage_from_metrics(invocation_metrics)
+                                    await self.stream_stats(sink, f"\n\n{stats}")
+        return usage
+
@@ -0,0 +1,192 @@
+import os
+import time
+import threading
+import concurrent.futures
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import app_bedrock
+import app_hedging
+import app_logging
+import app_router
+
+AWS_REGION = os.environ["AWS_REGION"]
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS", "10"))
+BEDROCK_WARMUP_CONNECTIONS = int(os.environ.get("BEDROCK_WARMUP_CONNECTIONS", "2"))
+BEDROCK_WARMUP_INTERVAL = float(os.environ.get("BEDROCK_WARMUP_INTERVAL", "0"))
+BEDROCK_WARMUP_PING = os.environ.get("BEDROCK_WARMUP_PING", "false").lower() == "true"
+BEDROCK_WARMUP_RETRY_INTERVAL = float(os.environ.get("BEDROCK_WARMUP_RETRY_INTERVAL", "30"))
+BEDROCK_DEFAULT_MODEL_ID = os.environ.get("BEDROCK_DEFAULT_MODEL_ID", "anthropic.claude-3-sonnet-20240229-v1:0")
+
+logger = app_logging.get_logger("clients")
+
+_lock = threading.Lock()
+_ready = threading.Event()
+_warm_up_thread = None
+_warm_up_error = None
+_bedrock = None
+_bedrock_runtime = {}
+_router = None
+_invoker = None
+_text_model_ids = None
+
+
+def client_config() -> Config:
+    return Config(
+        max_pool_connections = BEDROCK_MAX_POOL_CONNECTIONS,
+        tcp_keepalive = True,
+    )
+
+
+def get_bedrock():
+    global _bedrock
+    with _lock:
+        if _bedrock is None:
+            _bedrock = boto3.client("bedrock", region_name=AWS_REGION, config=client_config())
+        return _bedrock
+
+
+def get_bedrock_runtime(region : str = None):
+    region = region or AWS_REGION
+    with _lock:
+        if region not in _bedrock_runtime:
+            _bedrock_runtime[region] = boto3.client("bedrock-runtime", region_name=region, config=client_config())
+        return _bedrock_runtime[region]
+
+
+def get_router() -> app_router.BedrockRouter:
+    global _router
+    if _router is None:
+        router = app_router.BedrockRouter.from_env(AWS_REGION, get_bedrock_runtime)
+        with _lock:
+            if _router is None:
+                _router = router
+    return _router
+
+
+def get_invoker():
+    # The router, wrapped in the hedger when BEDROCK_HEDGING is on; both expose send_request
+    global _invoker
+    if _invoker is None:
+        invoker = app_hedging.Hedger(get_router()) if app_hedging.BEDROCK_HEDGING else get_router()
+        with _lock:
+            if _invoker is None:
+                _invoker = invoker
+    return _invoker
+
+
+def list_text_model_ids() -> list:
+    global _text_model_ids
+    if _text_model_ids is None:
+        response = get_bedrock().list_foundation_models(byOutputModality="TEXT")
+        _text_model_ids = [item['modelId'] for item in response["modelSummaries"]]
+    return _text_model_ids
+
+
+def readiness() -> dict:
+    # A failed warm-up is reported as degraded (not ready) until a retry succeeds
+    if not _ready.is_set():
+        return {"status": "warming"}
+    if _warm_up_error is not None:
+        return {"status": "degraded", "error": _warm_up_error}
+    return {"status": "ready"}
+
+
+def is_ready() -> bool:
+    return _ready.is_set() and _warm_up_error is None
+
+
+def wait_ready(timeout=None) -> bool:
+    return _ready.wait(timeout) and _warm_up_error is None
+
+
+def open_connection(bedrock_runtime, bedrock_model_id : str):
+    # An empty body is rejected with a ValidationException before any inference runs,
+    # so this costs no tokens but still resolves credentials and completes the TLS
+    # handshake, leaving a keep-alive connection in the client's pool.
+    try:
+        bedrock_runtime.invoke_model(modelId = bedrock_model_id, body = "{}")
+    except ClientError:
+        pass
+
+
+def warm_connections(bedrock_runtime, bedrock_model_id : str, connections : int):
+    if connections <= 0:
+        return
+    # Concurrent calls force the pool to open distinct connections rather than reuse one
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        for future in [executor.submit(open_connection, bedrock_runtime, bedrock_model_id) for _ in range(connections)]:
+            future.result()
+
+
+def ping(bedrock_runtime, invocation_model_id : str, bedrock_model_id : str):
+    model_strategy = app_bedrock.BedrockModelStrategyFactory.create(bedrock_model_id)
+    inference_parameters = dict (
+        temperature = 0,
+        top_p = 1,
+        top_k = 1,
+        max_tokens_to_sample = 1,
+    )
+    request = model_strategy.create_request(inference_parameters, "ping")
+    response = model_strategy.send_request(request, bedrock_runtime, invocation_model_id)
+    body = response["body"]
+    if hasattr(body, "read"):
+        body.read()
+    else:
+        for _ in body:
+            pass
+
+
+def warm_targets(with_ping : bool):
+    for target in get_router().targets:
+        if target.serves(BEDROCK_DEFAULT_MODEL_ID):
+            invocation_model_id = target.invocation_model_id(BEDROCK_DEFAULT_MODEL_ID)
+            warm_connections(target.client, invocation_model_id, BEDROCK_WARMUP_CONNECTIONS)
+            if with_ping:
+                ping(target.client, invocation_model_id, BEDROCK_DEFAULT_MODEL_ID)
+
+
+def warm_up() -> bool:
+    global _warm_up_error
+    start = time.perf_counter()
+    try:
+        list_text_model_ids()
+        warm_targets(BEDROCK_WARMUP_PING)
+        logger.info("Warm-up complete", extra={"fields": {
+            "model": BEDROCK_DEFAULT_MODEL_ID,
+            "connections": BEDROCK_WARMUP_CONNECTIONS,
+            "ping": BEDROCK_WARMUP_PING,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000)}})
+        _warm_up_error = None
+        return True
+    except Exception as e:
+        # Sessions fall back to lazy client creation; readiness reports the worker as degraded
+        logger.exception("Warm-up failed", extra={"fields": {"model": BEDROCK_DEFAULT_MODEL_ID}})
+        _warm_up_error = f"{type(e).__name__}: {e}"
+        return False
+    finally:
+        _ready.set()
+
+
+def keep_warm():
+    while True:
+        time.sleep(BEDROCK_WARMUP_INTERVAL)
+        try:
+            warm_targets(False)
+        except Exception:
+            logger.warning("Keep-warm failed", exc_info=True)
+
+
+def _run_warm_up():
+    while not warm_up():
+        time.sleep(BEDROCK_WARMUP_RETRY_INTERVAL)
+    if BEDROCK_WARMUP_INTERVAL > 0:
+        keep_warm()
+
+
+def start_warm_up():
+    global _warm_up_thread
+    with _lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=_run_warm_up, name="bedrock-warm-up", daemon=True)
+            _warm_up_thread.start()
@@ -0,0 +1,190 @@
+import os
+import time
+import threading
+import contextvars
+import collections
+import concurrent.futures
+import app_logging
+
+BEDROCK_HEDGING = os.environ.get("BEDROCK_HEDGING", "false").lower() == "true"
+BEDROCK_HEDGE_PERCENTILE = float(os.environ.get("BEDROCK_HEDGE_PERCENTILE", "95"))
+BEDROCK_HEDGE_HISTORY = int(os.environ.get("BEDROCK_HEDGE_HISTORY", "200"))
+BEDROCK_HEDGE_MIN_SAMPLES = int(os.environ.get("BEDROCK_HEDGE_MIN_SAMPLES", "20"))
+BEDROCK_HEDGE_MAX_RATE = float(os.environ.get("BEDROCK_HEDGE_MAX_RATE", "0.05"))
+BEDROCK_HEDGE_MAX_WORKERS = int(os.environ.get("BEDROCK_HEDGE_MAX_WORKERS", "32"))
+
+logger = app_logging.get_logger("hedging")
+
+END = object()
+
+
+class Attempt():
+
+    def __init__(self, name : str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.lost = False
+        self.body = None
+        self.future = None
+
+    def attach(self, body):
+        with self.lock:
+            self.body = body
+            lost = self.lost
+        if lost:
+            close(body)
+        return not lost
+
+    def cancel(self):
+        with self.lock:
+            self.lost = True
+            body = self.body
+        if body is not None:
+            close(body)
+
+
+def close(body):
+    if hasattr(body, "close"):
+        try:
+            body.close()
+        except Exception:
+            logger.debug("Closing hedged stream failed", exc_info=True)
+
+
+class HedgedStream():
+
+    # Replays the first event the winner already read, then continues with its stream
+    def __init__(self, first, iterator, stream):
+        self.first = first
+        self.iterator = iterator
+        self.stream = stream
+
+    def __iter__(self):
+        if self.first is not END:
+            yield self.first
+            yield from self.iterator
+
+    def close(self):
+        close(self.stream)
+
+
+class Hedger():
+
+    # Sits in front of the router with the same send_request signature. When the first
+    # event of a stream has not arrived by the model's recent TTFT percentile, a duplicate
+    # request is sent; the first stream to produce an event wins and the other is closed.
+    def __init__(self, invoker, percentile : float = BEDROCK_HEDGE_PERCENTILE, history : int = BEDROCK_HEDGE_HISTORY,
+                 min_samples : int = BEDROCK_HEDGE_MIN_SAMPLES, max_rate : float = BEDROCK_HEDGE_MAX_RATE, max_workers : int = BEDROCK_HEDGE_MAX_WORKERS):
+        self.invoker = invoker
+        self.percentile = percentile
+        self.history_size = history
+        self.min_samples = min_samples
+        self.max_rate = max_rate
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bedrock-hedge")
+        self.lock = threading.Lock()
+        self.history = {}
+        # Start times of the recent requests and of the hedges sent within that window
+        self.recent = collections.deque(maxlen=history)
+        self.recent_hedges = collections.deque()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def deadline(self, bedrock_model_id : str):
+        with self.lock:
+            samples = sorted(self.history.get(bedrock_model_id, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100))]
+
+    def record_ttft(self, bedrock_model_id : str, ttft : float):
+        with self.lock:
+            if bedrock_model_id not in self.history:
+                self.history[bedrock_model_id] = collections.deque(maxlen=self.history_size)
+            self.history[bedrock_model_id].append(ttft)
+
+    def allow_hedge(self) -> bool:
+        # Budget: hedges over the recent window may not exceed max_rate of its requests
+        with self.lock:
+            while self.recent_hedges and self.recent and self.recent_hedges[0] < self.recent[0]:
+                self.recent_hedges.popleft()
+            if len(self.recent_hedges) + 1 > self.max_rate * len(self.recent):
+                return False
+            self.recent_hedges.append(time.monotonic())
+            self.hedges += 1
+            return True
+
+    def first_event(self, attempt : Attempt, model_strategy, request : dict, bedrock_model_id : str):
+        response = self.invoker.send_request(model_strategy, request, bedrock_model_id)
+        body = response["body"]
+        if not attempt.attach(body):
+            return None
+        if hasattr(body, "read"):
+            # invoke_model: the whole body is already here
+            return response, END, None, time.perf_counter()
+        iterator = iter(body)
+        first = next(iterator, END)
+        return response, first, iterator, time.perf_counter()
+
+    def submit(self, name : str, model_strategy, request : dict, bedrock_model_id : str) -> Attempt:
+        attempt = Attempt(name)
+        # Attempts run in a copy of the caller's context so router logs keep its correlation id
+        attempt.future = self.executor.submit(contextvars.copy_context().run, self.first_event, attempt, model_strategy, request, bedrock_model_id)
+        return attempt
+
+    def send_request(self, model_strategy, request : dict, bedrock_model_id : str):
+        start = time.perf_counter()
+        deadline = self.deadline(bedrock_model_id)
+        with self.lock:
+            self.requests += 1
+            self.recent.append(time.monotonic())
+
+        attempts = [self.submit("primary", model_strategy, request, bedrock_model_id)]
+        if deadline is not None:
+            done, _ = concurrent.futures.wait([attempts[0].future], timeout=deadline)
+            if not done and self.allow_hedge():
+                logger.debug("Hedging", extra={"fields": {"model": bedrock_model_id, "deadline_ms": round(deadline * 1000)}})
+                attempts.append(self.submit("hedge", model_strategy, request, bedrock_model_id))
+
+        winner, result, error = self.first_success(attempts)
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.cancel()
+        if winner is None:
+            raise error
+
+        response, first, iterator, first_at = result
+        self.record_ttft(bedrock_model_id, first_at - start)
+        if winner.name == "hedge":
+            with self.lock:
+                self.hedge_wins += 1
+        if iterator is not None:
+            response["body"] = HedgedStream(first, iterator, response["body"])
+        return response
+
+    def first_success(self, attempts : list):
+        pending = {attempt.future: attempt for attempt in attempts}
+        error = None
+        while pending:
+            done, _ = concurrent.futures.wait(list(pending), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                attempt = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if result is not None:
+                    return attempt, result, None
+        return None, None, error
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": round(self.hedges / self.requests, 4) if self.requests else 0.0,
+                "deadlines_ms": {model: round(sorted(samples)[min(len(samples) - 1, int(len(samples) * self.percentile / 100))] * 1000, 1)
+                                 for model, samples in self.history.items() if len(samples) >= self.min_samples},
+            }
@@ -0,0 +1,142 @@
+import os
+import sys
+import copy
+import json
+import uuid
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import contextvars
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_CHUNK_SAMPLE_RATE = float(os.environ.get("LOG_CHUNK_SAMPLE_RATE", "0.01"))
+LOG_REDACT_PROMPTS = os.environ.get("LOG_REDACT_PROMPTS", "true").lower() != "false"
+
+LOGGER_NAMESPACE = "bedrock_llm"
+
+# Request fields that carry user content and must not reach the logs verbatim
+REDACTED_FIELDS = ("prompt", "inputText", "messages", "system")
+
+correlation_id = contextvars.ContextVar("correlation_id", default="-")
+
+_listener = None
+_chunk_sample_rate = LOG_CHUNK_SAMPLE_RATE
+_redact_prompts = LOG_REDACT_PROMPTS
+
+
+def get_logger(name : str) -> logging.Logger:
+    return logging.getLogger(f"{LOGGER_NAMESPACE}.{name}")
+
+
+def new_correlation_id() -> str:
+    cid = uuid.uuid4().hex[:12]
+    correlation_id.set(cid)
+    return cid
+
+
+class CorrelationIdFilter(logging.Filter):
+
+    # Runs on the calling task (not the listener thread) so the contextvar is still visible
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "correlation_id": getattr(record, "correlation_id", "-"),
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+
+    # The stock prepare() folds the traceback into msg and clears exc_info/exc_text;
+    # keep the message and the formatted traceback apart so JsonFormatter can emit "exc"
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def setup_logging(level=None, chunk_sample_rate=None, redact_prompts=None, stream=None):
+    # Records are pushed onto an unbounded queue from the event loop and written to
+    # the stream by a QueueListener thread, so logging never blocks on stdout.
+    global _listener, _chunk_sample_rate, _redact_prompts
+
+    if chunk_sample_rate is not None:
+        _chunk_sample_rate = chunk_sample_rate
+    if redact_prompts is not None:
+        _redact_prompts = redact_prompts
+
+    logger = logging.getLogger(LOGGER_NAMESPACE)
+    logger.setLevel(level if level is not None else LOG_LEVEL)
+
+    if _listener:
+        return logger
+
+    log_queue = queue.SimpleQueue()
+
+    stream_handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationIdFilter())
+
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+    return logger
+
+
+def shutdown_logging():
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+def should_log_chunk(logger : logging.Logger) -> bool:
+    # Chunk-level events are sampled; call sites check this before building the record
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < _chunk_sample_rate
+
+
+def redact_text(text) -> str:
+    if not _redact_prompts:
+        return text
+    return f"<redacted {len(text) if text else 0} chars>"
+
+
+def redact(request : dict) -> dict:
+    if not _redact_prompts or not isinstance(request, dict):
+        return request
+    redacted = {}
+    for key, value in request.items():
+        if key in REDACTED_FIELDS:
+            redacted[key] = redact_text(value if isinstance(value, str) else json.dumps(value, default=str))
+        else:
+            redacted[key] = value
+    return redacted
@@ -0,0 +1,173 @@
+import os
+
+# Literal tokens some providers leak into the generated text
+POSTPROCESS_ARTIFACTS = [artifact for artifact in os.environ.get("POSTPROCESS_ARTIFACTS", "</s>,<|endoftext|>,<EOS_TOKEN>").split(",") if artifact]
+
+
+class StopSequenceReached(Exception):
+    pass
+
+
+def partial_suffix(text : str, patterns : list, longest : int) -> int:
+    # Length of the longest tail of text that could still grow into one of the patterns
+    for size in range(min(longest, len(text)), 0, -1):
+        tail = text[-size:]
+        for pattern in patterns:
+            if pattern.startswith(tail):
+                return size
+    return 0
+
+
+class ArtifactStage():
+
+    # Drops artifact literals even when they are split across deltas, and the
+    # leading whitespace some completion models put in front of the first token
+    def __init__(self, artifacts : list = POSTPROCESS_ARTIFACTS, strip_leading_whitespace : bool = True):
+        self.artifacts = [artifact for artifact in artifacts if artifact]
+        self.longest = max([len(artifact) for artifact in self.artifacts], default=0)
+        self.strip_leading_whitespace = strip_leading_whitespace
+        self.started = False
+        self.pending = ""
+        self.stopped = False
+
+    def feed(self, delta : str) -> str:
+        text = self.pending + delta
+        if not self.started:
+            if self.strip_leading_whitespace:
+                text = text.lstrip()
+            if not text:
+                self.pending = ""
+                return ""
+            self.started = True
+        for artifact in self.artifacts:
+            if artifact in text:
+                text = text.replace(artifact, "")
+        held = partial_suffix(text, self.artifacts, self.longest - 1)
+        self.pending = text[len(text) - held:] if held else ""
+        return text[:len(text) - held]
+
+    def finish(self) -> str:
+        text, self.pending = self.pending, ""
+        return text
+
+
+class StopSequenceStage():
+
+    # Only the tail that may be the start of a stop sequence is held back, so each
+    # delta costs O(len(delta) + longest stop sequence)
+    def __init__(self, stop_sequences : list):
+        self.stop_sequences = [stop_sequence for stop_sequence in stop_sequences if stop_sequence]
+        self.longest = max([len(stop_sequence) for stop_sequence in self.stop_sequences], default=0)
+        self.pending = ""
+        self.stopped = False
+
+    def feed(self, delta : str) -> str:
+        if self.stopped:
+            return ""
+        if not self.stop_sequences:
+            return delta
+        text = self.pending + delta
+        indexes = [index for index in (text.find(stop_sequence) for stop_sequence in self.stop_sequences) if index >= 0]
+        if indexes:
+            self.stopped = True
+            self.pending = ""
+            return text[:min(indexes)]
+        held = partial_suffix(text, self.stop_sequences, self.longest - 1)
+        self.pending = text[len(text) - held:] if held else ""
+        return text[:len(text) - held]
+
+    def finish(self) -> str:
+        text, self.pending = self.pending, ""
+        return text
+
+
+class CodeFenceStage():
+
+    # Tracks ``` fences at the start of a line one character at a time and closes
+    # a fence left open when the stream ends (max tokens, stop sequence, error)
+    def __init__(self):
+        self.in_fence = False
+        self.line_start = True
+        self.backticks = 0
+        self.stopped = False
+
+    def feed(self, delta : str) -> str:
+        for char in delta:
+            if char == "\n":
+                self.line_start = True
+                self.backticks = 0
+            elif self.line_start and char == "`":
+                self.backticks += 1
+                if self.backticks == 3:
+                    self.in_fence = not self.in_fence
+                    self.line_start = False
+            elif self.line_start and char == " " and self.backticks == 0:
+                pass
+            else:
+                self.line_start = False
+        return delta
+
+    def finish(self) -> str:
+        if not self.in_fence:
+            return ""
+        self.in_fence = False
+        self.line_start = True
+        self.backticks = 0
+        return "\n```"
+
+
+class StreamPipeline():
+
+    def __init__(self, stages : list):
+        self.stages = stages
+
+    @property
+    def stopped(self) -> bool:
+        return any(stage.stopped for stage in self.stages)
+
+    def feed(self, delta : str) -> str:
+        for stage in self.stages:
+            if not delta:
+                return ""
+            delta = stage.feed(delta)
+        return delta
+
+    def finish(self) -> str:
+        text = ""
+        for stage in self.stages:
+            text = (stage.feed(text) if text else "") + stage.finish()
+        return text
+
+    @staticmethod
+    def create(inference_parameters : dict) -> "StreamPipeline":
+        return StreamPipeline([
+            ArtifactStage(),
+            StopSequenceStage(inference_parameters.get("stop_sequences") or []),
+            CodeFenceStage(),
+        ])
+
+
+class PostProcessedMessage():
+
+    # Wraps the sink (a cl.Message or any TokenSink) the strategies stream into. Generated
+    # text goes through the pipeline; stats lines go through stream_raw after it is flushed.
+    def __init__(self, msg, pipeline : StreamPipeline):
+        self.msg = msg
+        self.pipeline = pipeline
+
+    async def stream_token(self, token : str):
+        text = self.pipeline.feed(token)
+        if text:
+            await self.msg.stream_token(text)
+        if self.pipeline.stopped:
+            raise StopSequenceReached()
+
+    async def stream_raw(self, token : str):
+        await self.finish()
+        stream_raw = getattr(self.msg, "stream_raw", self.msg.stream_token)
+        await stream_raw(token)
+
+    async def finish(self):
+        text = self.pipeline.finish()
+        if text:
+            await self.msg.stream_token(text)
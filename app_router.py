@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import random
+import threading
+from botocore.exceptions import BotoCoreError, ClientError
+import app_logging
+
+# Example: [{"region": "us-east-1"}, {"region": "us-west-2"},
+#           {"region": "us-east-1", "model_id": "anthropic.claude-3-sonnet-20240229-v1:0", "target": "arn:aws:bedrock:us-east-1:123456789012:provisioned-model/abc"}]
+BEDROCK_ROUTES = os.environ.get("BEDROCK_ROUTES", "")
+BEDROCK_ROUTER_EWMA_ALPHA = float(os.environ.get("BEDROCK_ROUTER_EWMA_ALPHA", "0.2"))
+BEDROCK_ROUTER_ERROR_PENALTY = float(os.environ.get("BEDROCK_ROUTER_ERROR_PENALTY", "4"))
+BEDROCK_ROUTER_FAILURE_THRESHOLD = int(os.environ.get("BEDROCK_ROUTER_FAILURE_THRESHOLD", "3"))
+BEDROCK_ROUTER_COOLDOWN = float(os.environ.get("BEDROCK_ROUTER_COOLDOWN", "30"))
+BEDROCK_ROUTER_EXPLORE = float(os.environ.get("BEDROCK_ROUTER_EXPLORE", "0.05"))
+
+# Errors that say something about the target rather than the request; the next target is tried
+TARGET_ERROR_CODES = (
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "ServiceQuotaExceededException",
+    "InternalServerException",
+    "ModelTimeoutException",
+    "ModelNotReadyException",
+    "AccessDeniedException",
+    "ResourceNotFoundException",
+)
+
+logger = app_logging.get_logger("router")
+
+
+class NoHealthyTargetError(Exception):
+    pass
+
+
+class RouteTarget():
+
+    def __init__(self, name : str, region : str, client, model_id : str = None, target : str = None):
+        self.name = name
+        self.region = region
+        self.client = client
+        self.model_id = model_id
+        self.target = target
+        self.ttft = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def serves(self, bedrock_model_id : str) -> bool:
+        return self.model_id is None or self.model_id == bedrock_model_id
+
+    def invocation_model_id(self, bedrock_model_id : str) -> str:
+        return self.target if self.target else bedrock_model_id
+
+    def available(self, now : float) -> bool:
+        # Once the cooldown has passed the circuit is half-open: traffic flows again,
+        # but consecutive_failures is still at the threshold so one more failure re-opens it
+        return now >= self.open_until
+
+    def score(self, prior : float) -> float:
+        # Targets without a measured TTFT use the prior (the slowest known TTFT), so a
+        # target that has only ever failed is still ranked by its error rate
+        ttft = self.ttft if self.ttft is not None else prior
+        return ttft * (1 + BEDROCK_ROUTER_ERROR_PENALTY * self.error_rate)
+
+    def record_success(self, ttft : float):
+        with self.lock:
+            self.ttft = ttft if self.ttft is None else BEDROCK_ROUTER_EWMA_ALPHA * ttft + (1 - BEDROCK_ROUTER_EWMA_ALPHA) * self.ttft
+            self.error_rate = (1 - BEDROCK_ROUTER_EWMA_ALPHA) * self.error_rate
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+
+    def record_failure(self):
+        with self.lock:
+            self.error_rate = BEDROCK_ROUTER_EWMA_ALPHA + (1 - BEDROCK_ROUTER_EWMA_ALPHA) * self.error_rate
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= BEDROCK_ROUTER_FAILURE_THRESHOLD:
+                self.open_until = time.monotonic() + BEDROCK_ROUTER_COOLDOWN
+                logger.warning("Circuit open", extra={"fields": {"target": self.name, "error_rate": round(self.error_rate, 3), "cooldown": BEDROCK_ROUTER_COOLDOWN}})
+
+    def stats(self) -> dict:
+        return {
+            "target": self.name,
+            "ttft_ms": round(self.ttft * 1000, 1) if self.ttft is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "open": time.monotonic() < self.open_until,
+        }
+
+
+class RoutedStream():
+
+    # Times the first event of a streamed response and reports mid-stream failures to the target
+    def __init__(self, stream, target : RouteTarget, start : float):
+        self.stream = stream
+        self.target = target
+        self.start = start
+
+    def __iter__(self):
+        first = True
+        try:
+            for event in self.stream:
+                if first:
+                    self.target.record_success(time.perf_counter() - self.start)
+                    first = False
+                yield event
+        except (BotoCoreError, ClientError):
+            self.target.record_failure()
+            raise
+
+    def close(self):
+        if hasattr(self.stream, "close"):
+            self.stream.close()
+
+
+class BedrockRouter():
+
+    def __init__(self, targets : list):
+        self.targets = targets
+
+    @staticmethod
+    def from_routes(routes : list, client_factory) -> "BedrockRouter":
+        targets = []
+        for route in routes:
+            region = route["region"]
+            name = route.get("name") or (f"{region}/{route['target']}" if route.get("target") else region)
+            targets.append(RouteTarget(name, region, client_factory(region), route.get("model_id"), route.get("target")))
+        return BedrockRouter(targets)
+
+    @staticmethod
+    def from_env(default_region : str, client_factory) -> "BedrockRouter":
+        routes = json.loads(BEDROCK_ROUTES) if BEDROCK_ROUTES else [{"region": default_region}]
+        return BedrockRouter.from_routes(routes, client_factory)
+
+    def candidates(self, bedrock_model_id : str) -> list:
+        now = time.monotonic()
+        serving = [target for target in self.targets if target.serves(bedrock_model_id)]
+        prior = max([target.ttft for target in serving if target.ttft is not None], default=0.0)
+        # On equal scores: fewer errors first, then untried targets (so each is measured
+        # once), then dedicated (provisioned) targets over shared on-demand ones
+        candidates = sorted([target for target in serving if target.available(now)],
+                            key=lambda target: (target.score(prior), target.error_rate, target.ttft is not None, target.model_id is None))
+        if not candidates and serving:
+            # Every circuit is open (always the case for a lone target after a burst of
+            # throttling): probe the one whose cooldown ends first instead of failing outright
+            return [min(serving, key=lambda target: target.open_until)]
+        if len(candidates) > 1 and random.random() < BEDROCK_ROUTER_EXPLORE:
+            # Occasionally lead with another target so a recovered region gets re-measured
+            candidates.insert(0, candidates.pop(random.randrange(1, len(candidates))))
+        return candidates
+
+    def send_request(self, model_strategy, request : dict, bedrock_model_id : str):
+        candidates = self.candidates(bedrock_model_id)
+        if not candidates:
+            raise NoHealthyTargetError(f"No Bedrock target serves the model. Model={bedrock_model_id}")
+
+        for index, target in enumerate(candidates):
+            start = time.perf_counter()
+            try:
+                response = model_strategy.send_request(request, target.client, target.invocation_model_id(bedrock_model_id))
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in TARGET_ERROR_CODES:
+                    raise
+                target.record_failure()
+                if index == len(candidates) - 1:
+                    raise
+                logger.warning("Target failed, trying next", extra={"fields": {"target": target.name, "error": e.response["Error"]["Code"]}})
+                continue
+            except BotoCoreError:
+                target.record_failure()
+                if index == len(candidates) - 1:
+                    raise
+                logger.warning("Target unreachable, trying next", extra={"fields": {"target": target.name}}, exc_info=True)
+                continue
+
+            logger.debug("Routed", extra={"fields": {"target": target.name, "model": bedrock_model_id}})
+            # Lets callers tell which target served the call (usage is priced differently on provisioned throughput)
+            response["RouteTarget"] = target
+            body = response["body"]
+            if hasattr(body, "read"):
+                # invoke_model has already returned the full body
+                target.record_success(time.perf_counter() - start)
+            else:
+                response["body"] = RoutedStream(body, target, start)
+            return response
+
+    def stats(self) -> list:
+        return [target.stats() for target in self.targets]
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+import app_logging
+
+USAGE_DB_PATH = os.environ.get("USAGE_DB_PATH", "usage.db")
+USAGE_BATCH_SIZE = int(os.environ.get("USAGE_BATCH_SIZE", "100"))
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", "2"))
+# JSON object of model id -> [input, output] USD per 1k tokens, merged over COST_TABLE
+USAGE_COST_TABLE = os.environ.get("USAGE_COST_TABLE", "")
+
+# On-demand USD per 1k tokens (input, output); https://aws.amazon.com/bedrock/pricing/
+COST_TABLE = {
+    "anthropic.claude-3-opus-20240229-v1:0": (0.015, 0.075),
+    "anthropic.claude-3-sonnet-20240229-v1:0": (0.003, 0.015),
+    "anthropic.claude-3-haiku-20240307-v1:0": (0.00025, 0.00125),
+    "anthropic.claude-v2:1": (0.008, 0.024),
+    "anthropic.claude-v2": (0.008, 0.024),
+    "anthropic.claude-instant-v1": (0.0008, 0.0024),
+    "amazon.titan-text-express-v1": (0.0002, 0.0006),
+    "amazon.titan-text-lite-v1": (0.00015, 0.0002),
+    "cohere.command-text-v14": (0.0015, 0.002),
+    "cohere.command-light-text-v14": (0.0003, 0.0006),
+    "meta.llama2-13b-chat-v1": (0.00075, 0.001),
+    "meta.llama2-70b-chat-v1": (0.00195, 0.00256),
+    "mistral.mistral-7b-instruct-v0:2": (0.00015, 0.0002),
+    "mistral.mixtral-8x7b-instruct-v0:1": (0.00045, 0.0007),
+    "ai21.j2-mid-v1": (0.0125, 0.0125),
+    "ai21.j2-ultra-v1": (0.0188, 0.0188),
+}
+
+WINDOWS = {
+    "1h": 3600,
+    "24h": 86400,
+    "7d": 7 * 86400,
+    "30d": 30 * 86400,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    ts REAL NOT NULL,
+    user TEXT NOT NULL,
+    session_id TEXT,
+    model TEXT NOT NULL,
+    input_tokens INTEGER,
+    output_tokens INTEGER,
+    latency_ms INTEGER,
+    first_byte_latency_ms INTEGER,
+    cost REAL,
+    truncated INTEGER NOT NULL DEFAULT 0,
+    output_chunks INTEGER,
+    target TEXT
+);
+CREATE INDEX IF NOT EXISTS usage_ts ON usage (ts);
+CREATE INDEX IF NOT EXISTS usage_user_ts ON usage (user, ts);
+"""
+
+# Columns added after the first release; older ledgers gain them on startup
+MIGRATIONS = {
+    "truncated": "INTEGER NOT NULL DEFAULT 0",
+    "output_chunks": "INTEGER",
+    "target": "TEXT",
+}
+
+logger = app_logging.get_logger("usage")
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def cost_table() -> dict:
+    table = dict(COST_TABLE)
+    if USAGE_COST_TABLE:
+        table.update({model: tuple(price) for model, price in json.loads(USAGE_COST_TABLE).items()})
+    return table
+
+
+class UsageLedger():
+
+    # record() only enqueues; a writer thread batches rows into SQLite so responses never wait on disk
+    def __init__(self, db_path : str = USAGE_DB_PATH, batch_size : int = USAGE_BATCH_SIZE, flush_interval : float = USAGE_FLUSH_INTERVAL):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.costs = cost_table()
+        self.queue = queue.SimpleQueue()
+        self.stopped = threading.Event()
+        connection = self.connect()
+        try:
+            connection.executescript(SCHEMA)
+            self.migrate(connection)
+        finally:
+            connection.close()
+        self.writer = threading.Thread(target=self.run, name="usage-ledger", daemon=True)
+        self.writer.start()
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def migrate(self, connection : sqlite3.Connection):
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(usage)")]
+        with connection:
+            for column, definition in MIGRATIONS.items():
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE usage ADD COLUMN {column} {definition}")
+
+    def cost(self, model : str, input_tokens, output_tokens, provisioned : bool = False):
+        # Provisioned throughput is billed per hour, not per token; unknown counts are not priced
+        price = self.costs.get(model)
+        if price is None or provisioned or input_tokens is None or output_tokens is None:
+            return None
+        return (input_tokens * price[0] + output_tokens * price[1]) / 1000
+
+    def record(self, user : str, session_id : str, model : str, usage : dict):
+        input_tokens = usage.get("input_tokens")
+        output_tokens = usage.get("output_tokens")
+        self.queue.put((
+            time.time(),
+            user,
+            session_id,
+            model,
+            input_tokens,
+            output_tokens,
+            usage.get("latency_ms"),
+            usage.get("first_byte_latency_ms"),
+            self.cost(model, input_tokens, output_tokens, usage.get("provisioned", False)),
+            1 if usage.get("truncated") else 0,
+            usage.get("output_chunks"),
+            usage.get("target"),
+        ))
+
+    def run(self):
+        connection = self.connect()
+        try:
+            while not self.stopped.is_set() or not self.queue.empty():
+                batch = self.drain()
+                if batch:
+                    self.write(connection, batch)
+        finally:
+            connection.close()
+
+    def drain(self) -> list:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                break
+            batch.append(item)
+        return batch
+
+    def write(self, connection : sqlite3.Connection, batch : list):
+        try:
+            with connection:
+                connection.executemany("INSERT INTO usage (ts, user, session_id, model, input_tokens, output_tokens, latency_ms, first_byte_latency_ms, cost, truncated, output_chunks, target) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+        except sqlite3.Error:
+            logger.exception("Usage write failed", extra={"fields": {"rows": len(batch)}})
+
+    def close(self):
+        self.stopped.set()
+        self.queue.put(None)
+        self.writer.join(timeout=self.flush_interval + 5)
+
+    def aggregate(self, window : str = "24h", group_by : tuple = ("user", "model"), user : str = None) -> list:
+        columns = [column for column in group_by if column in ("user", "model", "session_id", "target")]
+        select = ", ".join(columns + [
+            "COUNT(*) AS invocations",
+            "SUM(input_tokens) AS input_tokens",
+            "SUM(output_tokens) AS output_tokens",
+            "AVG(latency_ms) AS avg_latency_ms",
+            "AVG(first_byte_latency_ms) AS avg_first_byte_latency_ms",
+            "SUM(cost) AS cost",
+            "SUM(truncated) AS truncated",
+            "SUM(output_chunks) AS output_chunks",
+        ])
+        sql = f"SELECT {select} FROM usage WHERE ts >= ?"
+        params = [time.time() - WINDOWS[window]]
+        if user is not None:
+            sql += " AND user = ?"
+            params.append(user)
+        if columns:
+            sql += f" GROUP BY {', '.join(columns)} ORDER BY cost DESC"
+        connection = self.connect()
+        try:
+            connection.row_factory = sqlite3.Row
+            return [dict(row) for row in connection.execute(sql, params)]
+        finally:
+            connection.close()
+
+
+def get_ledger() -> UsageLedger:
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger()
+            atexit.register(_ledger.close)
+        return _ledger
+
+
+def format_report(rows : list, window : str) -> str:
+    lines = [
+        f"Usage for the last {window}",
+        "",
+        "| user | model | invocations | truncated | token.in | token.out | avg latency (ms) | cost (USD) |",
+        "|---|---|---|---|---|---|---|---|",
+    ]
+    for row in rows:
+        cost = f"{row['cost']:.4f}" if row.get("cost") is not None else "-"
+        latency = round(row["avg_latency_ms"]) if row.get("avg_latency_ms") is not None else "-"
+        lines.append(f"| {row.get('user', '')} | {row.get('model', '')} | {row['invocations']} | {row['truncated'] or 0} | {row['input_tokens'] or 0} | {row['output_tokens'] or 0} | {latency} | {cost} |")
+    return "\n".join(lines)
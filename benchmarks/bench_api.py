@@ -0,0 +1,103 @@
+# Throughput of concurrent SSE streams through the OpenAI-compatible API against the fake runtime.
+#
+#   python benchmarks/bench_api.py
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import tempfile
+import statistics
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+import httpx
+import uvicorn
+import app_api
+import app_logging
+import app_router
+import app_usage
+from fake_bedrock import FakeBedrockRuntime, lognormal
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+API_KEY = "bench-key"
+CONCURRENCY = (1, 10, 50, 100)
+STREAMS_PER_CLIENT = 5
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(port : int):
+    # Runs in its own process so the load generator does not compete with the server for the GIL
+    app_logging.setup_logging(stream=open(os.devnull, "w"))
+    # 20 ms median TTFT, 50 tokens 5 ms apart: each stream takes roughly 270 ms
+    fake = FakeBedrockRuntime(ttft=lognormal(0.020, 0.5), token_interval=0.005, tokens=50)
+    router = app_router.BedrockRouter([app_router.RouteTarget("fake", "fake", fake)])
+    ledger = app_usage.UsageLedger(os.path.join(tempfile.mkdtemp(), "usage.db"))
+    api = app_api.create_api(invoker=router, ledger=ledger, api_keys=f"bench:{API_KEY}", max_concurrency=max(CONCURRENCY))
+    uvicorn.run(api, host="127.0.0.1", port=port, log_level="warning")
+
+
+def wait_for_server(port : int):
+    while True:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+
+
+async def stream_once(client : httpx.AsyncClient, ttfts : list) -> int:
+    body = {"model": MODEL_ID, "messages": [{"role": "user", "content": "hello"}], "max_tokens": 64, "stream": True}
+    start = time.perf_counter()
+    tokens = 0
+    async with client.stream("POST", "/v1/chat/completions", json=body, headers={"Authorization": f"Bearer {API_KEY}"}) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data: ") or line == "data: [DONE]":
+                continue
+            delta = json.loads(line[len("data: "):])["choices"][0]["delta"]
+            if delta.get("content"):
+                if tokens == 0:
+                    ttfts.append(time.perf_counter() - start)
+                tokens += 1
+    return tokens
+
+
+async def client_loop(client : httpx.AsyncClient, ttfts : list) -> int:
+    tokens = 0
+    for _ in range(STREAMS_PER_CLIENT):
+        tokens += await stream_once(client, ttfts)
+    return tokens
+
+
+async def run(base_url : str, concurrency : int):
+    ttfts = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        start = time.perf_counter()
+        tokens = sum(await asyncio.gather(*[client_loop(client, ttfts) for _ in range(concurrency)]))
+        elapsed = time.perf_counter() - start
+    streams = concurrency * STREAMS_PER_CLIENT
+    ttfts.sort()
+    print(f"concurrency={concurrency:<4} streams/s={streams / elapsed:7.1f}  tokens/s={tokens / elapsed:9.1f}  "
+          f"ttft p50={statistics.median(ttfts) * 1000:6.1f} ms  p99={ttfts[min(len(ttfts) - 1, int(0.99 * len(ttfts)))] * 1000:6.1f} ms")
+
+
+if __name__ == "__main__":
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(port,), daemon=True)
+    server.start()
+    try:
+        wait_for_server(port)
+        for concurrency in CONCURRENCY:
+            asyncio.run(run(f"http://127.0.0.1:{port}", concurrency))
+    finally:
+        server.terminate()
@@ -0,0 +1,71 @@
+# Hedged requests against a fake runtime with a heavy-tailed TTFT: p50/p99 time-to-first-token
+# and the extra invocations the hedges cost, with and without hedging.
+#
+#   python benchmarks/bench_hedging.py [requests]
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_bedrock
+import app_hedging
+import app_logging
+import app_router
+from fake_bedrock import FakeBedrockRuntime, lognormal
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+
+def percentile(values : list, p : float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def run(invoker, fake : FakeBedrockRuntime) -> dict:
+    model_strategy = app_bedrock.BedrockModelStrategyFactory.create(MODEL_ID)
+    request = model_strategy.create_request({"max_tokens_to_sample": 16}, "hello")
+    ttfts = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        response = invoker.send_request(model_strategy, request, MODEL_ID)
+        for event in response["body"]:
+            ttfts.append(time.perf_counter() - start)
+            break
+        response["body"].close()
+    return {"ttfts": ttfts, "invocations": fake.invocations}
+
+
+def report(label : str, result : dict, baseline : dict = None):
+    ttfts = result["ttfts"]
+    p50 = statistics.median(ttfts) * 1000
+    p99 = percentile(ttfts, 0.99) * 1000
+    extra = result["invocations"] / REQUESTS - 1
+    line = f"{label:<24} p50={p50:6.1f} ms  p99={p99:7.1f} ms  extra invocations={extra:6.1%}"
+    if baseline:
+        base_p99 = percentile(baseline["ttfts"], 0.99) * 1000
+        line += f"  p99 improvement={(base_p99 - p99) / base_p99:6.1%}"
+    print(line)
+
+
+def fake_router():
+    # median 20 ms, p99 around 200 ms
+    fake = FakeBedrockRuntime(ttft=lognormal(0.020, 1.0))
+    return fake, app_router.BedrockRouter([app_router.RouteTarget("fake", "fake", fake)])
+
+
+if __name__ == "__main__":
+    app_logging.setup_logging(stream=open(os.devnull, "w"))
+
+    fake, router = fake_router()
+    baseline = run(router, fake)
+    report("no hedging", baseline)
+
+    for max_rate, hedge_percentile in ((0.05, 95), (0.10, 90), (0.20, 80)):
+        fake, router = fake_router()
+        hedger = app_hedging.Hedger(router, percentile=hedge_percentile, max_rate=max_rate)
+        result = run(hedger, fake)
+        report(f"p{hedge_percentile} cap={max_rate:.0%}", result, baseline)
+        print(f"{'':<24} {hedger.stats()}")
@@ -0,0 +1,59 @@
+# Event-loop time spent streaming 1k chunks through a strategy with logging disabled/enabled.
+#
+#   python benchmarks/bench_logging.py
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_logging
+import app_bedrock
+
+CHUNKS = 1000
+RUNS = 20
+
+
+class NullMessage():
+
+    async def stream_token(self, token : str):
+        pass
+
+
+def cohere_stream(chunks : int):
+    events = []
+    for i in range(chunks):
+        generation = {"text": f"token{i} "}
+        if i == chunks - 1:
+            generation["finish_reason"] = "COMPLETE"
+        events.append({"chunk": {"bytes": json.dumps({"generations": [generation]}).encode()}})
+    return events
+
+
+async def run(strategy, events) -> float:
+    msg = NullMessage()
+    start = time.perf_counter()
+    await strategy.process_response_stream(events, msg)
+    return time.perf_counter() - start
+
+
+def measure(label : str, level, chunk_sample_rate : float):
+    app_logging.setup_logging(level=level, chunk_sample_rate=chunk_sample_rate, stream=open(os.devnull, "w"))
+    strategy = app_bedrock.CohereBedrockModelStrategy()
+    events = cohere_stream(CHUNKS)
+    timings = [asyncio.run(run(strategy, events)) for _ in range(RUNS)]
+    median_ms = statistics.median(timings) * 1000
+    print(f"{label:<32} {median_ms:8.3f} ms / {CHUNKS} chunks")
+    return median_ms
+
+
+if __name__ == "__main__":
+    baseline = measure("disabled (WARNING)", logging.WARNING, 0.0)
+    for rate in (0.01, 0.1, 1.0):
+        elapsed = measure(f"enabled (DEBUG, sample={rate})", logging.DEBUG, rate)
+        print(f"{'':<32} +{elapsed - baseline:7.3f} ms overhead")
+    app_logging.shutdown_logging()
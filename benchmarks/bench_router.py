@@ -0,0 +1,68 @@
+# Latency-aware routing across fake regions with different latency and error profiles.
+#
+#   python benchmarks/bench_router.py [requests]
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_bedrock
+import app_logging
+import app_router
+from botocore.exceptions import ClientError
+from fake_bedrock import FakeBedrockRuntime, fixed, lognormal
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+PROFILES = {
+    "fast": lambda: FakeBedrockRuntime(ttft=lognormal(0.010, 0.3)),
+    "slow": lambda: FakeBedrockRuntime(ttft=lognormal(0.040, 0.3)),
+    "throttled": lambda: FakeBedrockRuntime(ttft=fixed(0.005), error_rate=0.7),
+}
+
+
+def percentile(values : list, p : float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def run(router : app_router.BedrockRouter) -> dict:
+    model_strategy = app_bedrock.BedrockModelStrategyFactory.create(MODEL_ID)
+    request = model_strategy.create_request({"max_tokens_to_sample": 16}, "hello")
+    ttfts = []
+    errors = 0
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        try:
+            response = router.send_request(model_strategy, request, MODEL_ID)
+            for event in response["body"]:
+                ttfts.append(time.perf_counter() - start)
+                break
+        except (ClientError, app_router.NoHealthyTargetError):
+            errors += 1
+    return {"ttfts": ttfts, "errors": errors}
+
+
+def report(label : str, result : dict, router : app_router.BedrockRouter):
+    ttfts = result["ttfts"]
+    if ttfts:
+        print(f"{label:<22} p50={statistics.median(ttfts) * 1000:6.1f} ms  p99={percentile(ttfts, 0.99) * 1000:6.1f} ms  errors={result['errors']}")
+    else:
+        print(f"{label:<22} no successful requests  errors={result['errors']}")
+    for target in router.targets:
+        print(f"{'':<22} {target.name:<10} invocations={target.client.invocations:<5} {target.stats()}")
+
+
+if __name__ == "__main__":
+    app_logging.setup_logging(stream=open(os.devnull, "w"))
+
+    for name, factory in PROFILES.items():
+        router = app_router.BedrockRouter([app_router.RouteTarget(name, name, factory())])
+        report(f"single ({name})", run(router), router)
+
+    clients = {name: factory() for name, factory in PROFILES.items()}
+    router = app_router.BedrockRouter.from_routes([{"region": name} for name in PROFILES], lambda region: clients[region])
+    report("routed", run(router), router)
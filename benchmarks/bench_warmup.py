@@ -0,0 +1,52 @@
+# First-request time-to-first-token with and without the startup warm-up.
+# Each sample runs in a fresh process so credentials, clients and connections start cold.
+# Requires AWS credentials and AWS_REGION; the request goes to BEDROCK_DEFAULT_MODEL_ID.
+#
+#   python benchmarks/bench_warmup.py [samples]
+import os
+import sys
+import time
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SAMPLES = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 5
+
+
+def first_request_ttft(warm : bool) -> float:
+    import app_bedrock
+    import app_clients
+
+    if warm:
+        app_clients.warm_up()
+
+    start = time.perf_counter()
+    bedrock_runtime = app_clients.get_bedrock_runtime()
+    model_strategy = app_bedrock.BedrockModelStrategyFactory.create(app_clients.BEDROCK_DEFAULT_MODEL_ID)
+    inference_parameters = dict (
+        temperature = 0,
+        top_p = 1,
+        top_k = 1,
+        max_tokens_to_sample = 16,
+    )
+    request = model_strategy.create_request(inference_parameters, "Say hello.")
+    response = model_strategy.send_request(request, bedrock_runtime, app_clients.BEDROCK_DEFAULT_MODEL_ID)
+    for _ in response["body"]:
+        break
+    return time.perf_counter() - start
+
+
+def sample(mode : str) -> float:
+    output = subprocess.check_output([sys.executable, __file__, mode], text=True)
+    return float(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ("--cold", "--warm"):
+        print(first_request_ttft(sys.argv[1] == "--warm"))
+        sys.exit(0)
+
+    for mode in ("--cold", "--warm"):
+        timings = [sample(mode) for _ in range(SAMPLES)]
+        print(f"{mode[2:]:<6} ttft median={statistics.median(timings) * 1000:8.1f} ms  max={max(timings) * 1000:8.1f} ms")
@@ -0,0 +1,91 @@
+# In-process stand-in for a bedrock-runtime client with a configurable latency profile.
+# Responses use the Claude 3 messages format.
+import io
+import json
+import math
+import time
+import random
+import threading
+from botocore.exceptions import ClientError
+
+
+def fixed(seconds : float):
+    return lambda: seconds
+
+
+def lognormal(median : float, sigma : float):
+    # Heavy right tail: p99 is roughly median * exp(2.33 * sigma)
+    return lambda: random.lognormvariate(math.log(median), sigma)
+
+
+class FakeBedrockRuntime():
+
+    # fail_after: number of tokens streamed before the stream raises a ModelStreamErrorException
+    def __init__(self, ttft=fixed(0.01), token_interval : float = 0.0, tokens : int = 20, error_rate : float = 0.0, error_code : str = "ThrottlingException", fail_after : int = None):
+        self.ttft = ttft
+        self.token_interval = token_interval
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.fail_after = fail_after
+        self.invocations = 0
+
+    def maybe_fail(self, operation : str):
+        if random.random() < self.error_rate:
+            raise ClientError({"Error": {"Code": self.error_code, "Message": "fake"}}, operation)
+
+    def invoke_model(self, modelId : str, body):
+        self.invocations += 1
+        self.maybe_fail("InvokeModel")
+        time.sleep(self.ttft())
+        text = " ".join(f"token{i}" for i in range(self.tokens))
+        response_body = {
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "usage": {"input_tokens": 10, "output_tokens": self.tokens},
+        }
+        return {"body": io.BytesIO(json.dumps(response_body).encode())}
+
+    def invoke_model_with_response_stream(self, modelId : str, body):
+        self.invocations += 1
+        self.maybe_fail("InvokeModelWithResponseStream")
+        return {"body": FakeEventStream(self.ttft(), self.token_interval, self.tokens, self.fail_after)}
+
+
+class FakeEventStream():
+
+    # close() may be called from another thread and ends the stream like a dropped connection
+    def __init__(self, ttft : float, token_interval : float, tokens : int, fail_after : int = None):
+        self.ttft = ttft
+        self.token_interval = token_interval
+        self.tokens = tokens
+        self.fail_after = fail_after
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+    def __iter__(self):
+        start = time.perf_counter()
+        if self.closed.wait(self.ttft):
+            return
+        yield self.event({"type": "message_start", "message": {"usage": {"input_tokens": 10}}})
+        for i in range(self.tokens):
+            if i and self.token_interval and self.closed.wait(self.token_interval):
+                return
+            if self.closed.is_set():
+                return
+            if i == self.fail_after:
+                raise ClientError({"Error": {"Code": "ModelStreamErrorException", "Message": "fake"}}, "InvokeModelWithResponseStream")
+            yield self.event({"type": "content_block_delta", "delta": {"type": "text_delta", "text": f"token{i} "}})
+        yield self.event({"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": self.tokens}})
+        yield self.event({"type": "message_stop", "amazon-bedrock-invocationMetrics": {
+            "inputTokenCount": 10,
+            "outputTokenCount": self.tokens,
+            "invocationLatency": round((time.perf_counter() - start) * 1000),
+            "firstByteLatency": round(self.ttft * 1000),
+        }})
+
+    @staticmethod
+    def event(payload : dict) -> dict:
+        return {"chunk": {"bytes": json.dumps(payload).encode()}}
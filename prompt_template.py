@@ -53,4 +53,10 @@ The AI is talkative and provides lots of specific details from its context. If t
     }
     
     return templates.get(provider, "anthropic")
-    
\ No newline at end of file
+    
+
+def get_model_template(bedrock_model_id):
+    # Claude 3 uses the messages API; the template is just the user input
+    if bedrock_model_id.startswith("anthropic.claude-3"):
+        return '{input}'
+    return get_template(bedrock_model_id.split(".")[0])
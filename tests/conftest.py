@@ -0,0 +1,11 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The app modules live at the repository root and the fake endpoints under benchmarks/
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# app_clients reads the region at import; the tests never reach AWS
+os.environ.setdefault("AWS_REGION", "us-east-1")
@@ -0,0 +1,171 @@
+import json
+import pytest
+from fastapi.testclient import TestClient
+import app_api
+import app_router
+import app_usage
+from fake_bedrock import FakeBedrockRuntime
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+HEADERS = {"Authorization": "Bearer secret"}
+
+
+class RecordingRuntime(FakeBedrockRuntime):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = []
+
+    def invoke_model_with_response_stream(self, modelId : str, body):
+        self.requests.append(json.loads(body))
+        return super().invoke_model_with_response_stream(modelId, body)
+
+
+@pytest.fixture
+def runtime():
+    return RecordingRuntime(tokens=10)
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    ledger = app_usage.UsageLedger(str(tmp_path / "usage.db"), flush_interval=0.05)
+    yield ledger
+    ledger.close()
+
+
+@pytest.fixture
+def client(runtime, ledger):
+    router = app_router.BedrockRouter([app_router.RouteTarget("fake", "us-east-1", runtime)])
+    return TestClient(app_api.create_api(invoker=router, ledger=ledger, api_keys="alice:secret", max_concurrency=4))
+
+
+def completion(client : TestClient, **body):
+    body.setdefault("model", MODEL_ID)
+    body.setdefault("messages", [{"role": "user", "content": "hello"}])
+    return client.post("/v1/chat/completions", headers=HEADERS, json=body)
+
+
+def events(response) -> list:
+    lines = [line for line in response.text.split("\n") if line.startswith("data: ")]
+    return [line[len("data: "):] for line in lines]
+
+
+def test_missing_or_invalid_key_is_rejected(client):
+    body = {"model": MODEL_ID, "messages": [{"role": "user", "content": "hello"}]}
+    assert client.post("/v1/chat/completions", json=body).status_code == 401
+    assert client.post("/v1/chat/completions", headers={"Authorization": "Bearer wrong"}, json=body).status_code == 401
+    assert client.get("/v1/models").status_code == 401
+
+
+@pytest.mark.parametrize("content", [b"{not json", b"[1, 2]", b"\"text\""])
+def test_malformed_body_is_rejected(client, content):
+    response = client.post("/v1/chat/completions", headers={**HEADERS, "Content-Type": "application/json"}, content=content)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("body", [
+    {"model": None},
+    {"messages": []},
+    {"messages": "hello"},
+    {"messages": ["hello"]},
+    {"messages": [{"role": "user", "content": {"text": "hello"}}]},
+    {"messages": [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": "https://example.com/a.png"}}]}]},
+    {"messages": [{"role": "system", "content": "be brief"}]},
+    {"model": "unknown.model-v1"},
+    {"temperature": "hot"},
+    {"max_tokens": "many"},
+    {"stop": 5},
+    {"stop": ["###", 5]},
+])
+def test_invalid_request_is_rejected(client, runtime, body):
+    response = completion(client, **body)
+    assert response.status_code == 400
+    assert runtime.invocations == 0
+
+
+def test_null_parameters_use_defaults(client, runtime):
+    response = completion(client, temperature=None, top_p=None, top_k=None)
+    assert response.status_code == 200
+    request = runtime.requests[0]
+    assert request["temperature"] == 0.3
+    assert request["top_p"] == 1.0
+    assert request["top_k"] == 250
+
+
+def test_text_content_parts_are_joined(client, runtime):
+    response = completion(client, messages=[
+        {"role": "system", "content": [{"type": "text", "text": "Be brief."}]},
+        {"role": "user", "content": [{"type": "text", "text": "hello "}, {"type": "text", "text": "there {history}"}]},
+    ])
+    assert response.status_code == 200
+    request = runtime.requests[0]
+    assert request["system"] == "Be brief."
+    assert "hello there {history}" in request["messages"][0]["content"]
+
+
+def test_json_completion(client, ledger):
+    response = completion(client)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["object"] == "chat.completion"
+    assert body["model"] == MODEL_ID
+    choice = body["choices"][0]
+    assert choice["message"]["role"] == "assistant"
+    assert choice["message"]["content"] == "".join(f"token{i} " for i in range(10))
+    assert choice["finish_reason"] == "stop"
+    assert body["usage"] == {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20}
+
+    ledger.close()
+    rows = ledger.aggregate("1h")
+    assert rows[0]["user"] == "alice"
+    assert rows[0]["input_tokens"] == 10
+    assert rows[0]["output_tokens"] == 10
+
+
+def test_max_tokens_finish_reason_is_length(client):
+    response = completion(client, max_tokens=10)
+    assert response.json()["choices"][0]["finish_reason"] == "length"
+
+
+def test_stream_chunks_end_with_done(client):
+    response = completion(client, stream=True)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    data = events(response)
+    assert data[-1] == "[DONE]"
+    chunks = [json.loads(item) for item in data[:-1]]
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant"}
+    assert "".join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks) == "".join(f"token{i} " for i in range(10))
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+    assert all("usage" not in chunk for chunk in chunks)
+
+
+def test_stop_sequence_ends_stream(client, ledger):
+    response = completion(client, stream=True, stop="token3")
+    chunks = [json.loads(item) for item in events(response)[:-1]]
+    assert "".join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks) == "token0 token1 token2 "
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+
+    ledger.close()
+    row = ledger.aggregate("1h")[0]
+    assert row["truncated"] == 1
+    assert row["output_tokens"] is None
+
+
+def test_stream_include_usage(client):
+    response = completion(client, stream=True, stream_options={"include_usage": True})
+    data = events(response)
+    assert data[-1] == "[DONE]"
+    usage_chunk = json.loads(data[-2])
+    assert usage_chunk["choices"] == []
+    assert usage_chunk["usage"] == {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20}
+
+
+def test_history_placeholder_in_input_is_kept():
+    prompt, _ = app_api.build_prompt("meta.llama2-13b-chat-v1", [
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": "hello"},
+        {"role": "user", "content": "print {history}"},
+    ])
+    assert "user: hi\nassistant: hello" in prompt
+    assert "print {history}" in prompt
@@ -0,0 +1,118 @@
+import time
+import threading
+import pytest
+from botocore.exceptions import ClientError
+import app_bedrock
+import app_hedging
+import app_logging
+import app_router
+from fake_bedrock import FakeBedrockRuntime, fixed
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+
+
+class RecordingRuntime(FakeBedrockRuntime):
+
+    # Keeps every stream it hands out; TTFTs are taken from the list in call order
+    def __init__(self, ttfts : list, **kwargs):
+        super().__init__(**kwargs)
+        self.ttfts = list(ttfts)
+        self.streams = []
+        self.ttft = lambda: self.ttfts.pop(0) if self.ttfts else 0.001
+
+    def invoke_model_with_response_stream(self, modelId : str, body):
+        response = super().invoke_model_with_response_stream(modelId, body)
+        self.streams.append(response["body"])
+        return response
+
+
+class FailingInvoker():
+
+    def __init__(self, delay : float):
+        self.delay = delay
+        self.calls = 0
+        self.correlation_ids = []
+        self.lock = threading.Lock()
+
+    def send_request(self, model_strategy, request : dict, bedrock_model_id : str):
+        with self.lock:
+            self.calls += 1
+            self.correlation_ids.append(app_logging.correlation_id.get())
+        time.sleep(self.delay)
+        raise ClientError({"Error": {"Code": "ModelTimeoutException", "Message": "fake"}}, "InvokeModelWithResponseStream")
+
+
+def model_request():
+    model_strategy = app_bedrock.BedrockModelStrategyFactory.create(MODEL_ID)
+    return model_strategy, model_strategy.create_request({"max_tokens_to_sample": 16}, "hello")
+
+
+def seed(hedger : app_hedging.Hedger, ttft : float, samples : int):
+    for _ in range(samples):
+        hedger.record_ttft(MODEL_ID, ttft)
+
+
+def test_budget_cap_holds_under_concurrency():
+    hedger = app_hedging.Hedger(None, max_rate=0.05, history=200)
+    for _ in range(200):
+        hedger.recent.append(time.monotonic())
+    barrier = threading.Barrier(50)
+    allowed = []
+
+    def attempt():
+        barrier.wait()
+        allowed.append(hedger.allow_hedge())
+
+    threads = [threading.Thread(target=attempt) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(allowed) == 10
+    assert hedger.stats()["hedges"] == 10
+
+
+def test_no_hedge_below_min_samples():
+    runtime = RecordingRuntime([0.05])
+    hedger = app_hedging.Hedger(app_router.BedrockRouter([app_router.RouteTarget("r", "r", runtime)]), min_samples=5, max_rate=1.0)
+    seed(hedger, 0.001, 4)
+    model_strategy, request = model_request()
+    response = hedger.send_request(model_strategy, request, MODEL_ID)
+    assert len(list(response["body"])) > 0
+    assert runtime.invocations == 1
+    assert hedger.stats()["hedges"] == 0
+
+
+def test_hedge_wins_on_slow_primary_and_loser_is_closed():
+    runtime = RecordingRuntime([1.0, 0.001])
+    hedger = app_hedging.Hedger(app_router.BedrockRouter([app_router.RouteTarget("r", "r", runtime)]), min_samples=5, max_rate=1.0)
+    seed(hedger, 0.01, 5)
+    model_strategy, request = model_request()
+    start = time.perf_counter()
+    response = hedger.send_request(model_strategy, request, MODEL_ID)
+    events = list(response["body"])
+    assert time.perf_counter() - start < 0.5
+    assert len(events) == runtime.tokens + 3
+    stats = hedger.stats()
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+    primary, hedge = runtime.streams
+    assert primary.closed.is_set()
+    assert not hedge.closed.is_set()
+
+
+def test_error_propagates_when_both_attempts_fail():
+    invoker = FailingInvoker(delay=0.05)
+    hedger = app_hedging.Hedger(invoker, min_samples=5, max_rate=1.0)
+    seed(hedger, 0.01, 5)
+    model_strategy, request = model_request()
+    token = app_logging.correlation_id.set("hedged-request")
+    try:
+        with pytest.raises(ClientError) as error:
+            hedger.send_request(model_strategy, request, MODEL_ID)
+    finally:
+        app_logging.correlation_id.reset(token)
+    assert error.value.response["Error"]["Code"] == "ModelTimeoutException"
+    assert invoker.calls == 2
+    # Attempts run on the hedger's pool but keep the caller's correlation id
+    assert invoker.correlation_ids == ["hedged-request", "hedged-request"]
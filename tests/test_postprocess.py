@@ -0,0 +1,66 @@
+import app_postprocess
+
+
+def run(pipeline : app_postprocess.StreamPipeline, deltas : list) -> str:
+    output = ""
+    for delta in deltas:
+        output += pipeline.feed(delta)
+        if pipeline.stopped:
+            break
+    return output + pipeline.finish()
+
+
+def test_stop_sequence_split_across_deltas():
+    stage = app_postprocess.StopSequenceStage(["###"])
+    assert stage.feed("answer #") == "answer "
+    assert stage.feed("#") == ""
+    assert not stage.stopped
+    assert stage.feed("# tail") == ""
+    assert stage.stopped
+    assert stage.feed("more") == ""
+
+
+def test_held_back_prefix_is_released_when_it_does_not_match():
+    stage = app_postprocess.StopSequenceStage(["END"])
+    assert stage.feed("THE EN") == "THE "
+    assert stage.feed("D") == ""
+    assert stage.stopped
+
+    stage = app_postprocess.StopSequenceStage(["END"])
+    assert stage.feed("THE EN") == "THE "
+    assert stage.feed("TRY") == "ENTRY"
+    assert stage.finish() == ""
+
+
+def test_pipeline_stops_at_earliest_stop_sequence():
+    pipeline = app_postprocess.StreamPipeline.create({"stop_sequences": ["STOP", "Human:"]})
+    assert run(pipeline, ["Hello Hu", "man: ignored STOP"]) == "Hello "
+    assert pipeline.stopped
+
+
+def test_artifact_removed_across_deltas():
+    stage = app_postprocess.ArtifactStage(["<|endoftext|>"])
+    output = stage.feed("  done<|end") + stage.feed("oftext|>") + stage.finish()
+    assert output == "done"
+
+
+def test_artifact_prefix_is_released_at_finish():
+    stage = app_postprocess.ArtifactStage(["</s>"])
+    assert stage.feed("a </") == "a "
+    assert stage.finish() == "</"
+
+
+def test_unterminated_code_fence_is_closed():
+    pipeline = app_postprocess.StreamPipeline.create({})
+    assert run(pipeline, ["Here:\n`", "``python\nprint(1)\n"]) == "Here:\n```python\nprint(1)\n\n```"
+
+
+def test_terminated_code_fence_is_left_alone():
+    pipeline = app_postprocess.StreamPipeline.create({})
+    text = "```\ncode\n```\ndone"
+    assert run(pipeline, [text[:5], text[5:12], text[12:]]) == text
+
+
+def test_code_fence_closed_after_stop_sequence():
+    pipeline = app_postprocess.StreamPipeline.create({"stop_sequences": ["###"]})
+    assert run(pipeline, ["```\ncode #", "## rest"]) == "```\ncode \n```"
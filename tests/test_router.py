@@ -0,0 +1,119 @@
+import time
+import pytest
+from botocore.exceptions import ClientError
+import app_bedrock
+import app_router
+from fake_bedrock import FakeBedrockRuntime, fixed
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+
+
+@pytest.fixture(autouse=True)
+def no_exploration(monkeypatch):
+    monkeypatch.setattr(app_router, "BEDROCK_ROUTER_EXPLORE", 0.0)
+
+
+def make_router(**clients) -> app_router.BedrockRouter:
+    return app_router.BedrockRouter([app_router.RouteTarget(name, name, client) for name, client in clients.items()])
+
+
+def send(router : app_router.BedrockRouter):
+    model_strategy = app_bedrock.BedrockModelStrategyFactory.create(MODEL_ID)
+    request = model_strategy.create_request({"max_tokens_to_sample": 16}, "hello")
+    response = router.send_request(model_strategy, request, MODEL_ID)
+    # TTFT is recorded when the first event of the stream is read
+    for _ in response["body"]:
+        break
+    return response
+
+
+def test_prefers_fast_target():
+    slow = FakeBedrockRuntime(ttft=fixed(0.03))
+    fast = FakeBedrockRuntime(ttft=fixed(0.001))
+    router = make_router(slow=slow, fast=fast)
+    for _ in range(20):
+        send(router)
+    # Each untried target is measured once, then the fast one takes all traffic
+    assert slow.invocations == 1
+    assert fast.invocations == 19
+
+
+def test_throttling_fails_over_to_next_target():
+    throttled = FakeBedrockRuntime(error_rate=1.0, error_code="ThrottlingException")
+    healthy = FakeBedrockRuntime()
+    router = make_router(throttled=throttled, healthy=healthy)
+    send(router)
+    assert throttled.invocations == 1
+    assert healthy.invocations == 1
+    assert router.targets[0].consecutive_failures == 1
+
+
+def test_never_successful_target_ranks_last():
+    denied = FakeBedrockRuntime(error_rate=1.0, error_code="AccessDeniedException")
+    fast = FakeBedrockRuntime(ttft=fixed(0.001))
+    slow = FakeBedrockRuntime(ttft=fixed(0.02))
+    router = make_router(denied=denied, fast=fast, slow=slow)
+    for _ in range(10):
+        send(router)
+    # Tried once while nothing was known, then scored from the prior and its error rate
+    assert denied.invocations == 1
+    assert slow.invocations == 1
+    assert fast.invocations == 9
+
+
+def test_circuit_opens_at_threshold_and_closes_after_cooldown(monkeypatch):
+    monkeypatch.setattr(app_router, "BEDROCK_ROUTER_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(app_router, "BEDROCK_ROUTER_COOLDOWN", 0.2)
+    flaky = FakeBedrockRuntime(ttft=fixed(0.001), error_rate=1.0)
+    backup = FakeBedrockRuntime(ttft=fixed(0.001))
+    router = make_router(flaky=flaky, backup=backup)
+    target = router.targets[0]
+
+    send(router)
+    assert not target.stats()["open"]
+    # flaky now scores worse than backup; with two targets, always exploring puts the
+    # worse-scoring one first, so flaky keeps leading whenever its circuit lets it
+    monkeypatch.setattr(app_router, "BEDROCK_ROUTER_EXPLORE", 1.0)
+    send(router)
+    assert target.stats()["open"]
+    assert flaky.invocations == 2
+
+    send(router)
+    assert flaky.invocations == 2
+
+    time.sleep(0.25)
+    flaky.error_rate = 0.0
+    send(router)
+    assert flaky.invocations == 3
+    assert not target.stats()["open"]
+    assert target.consecutive_failures == 0
+
+
+def test_lone_target_is_still_tried_while_open(monkeypatch):
+    monkeypatch.setattr(app_router, "BEDROCK_ROUTER_FAILURE_THRESHOLD", 1)
+    client = FakeBedrockRuntime(error_rate=1.0)
+    router = make_router(only=client)
+    for _ in range(3):
+        with pytest.raises(ClientError):
+            send(router)
+    assert client.invocations == 3
+    client.error_rate = 0.0
+    send(router)
+    assert not router.targets[0].stats()["open"]
+
+
+def test_request_error_is_raised_without_failover():
+    invalid = FakeBedrockRuntime(error_rate=1.0, error_code="ValidationException")
+    healthy = FakeBedrockRuntime()
+    router = make_router(invalid=invalid, healthy=healthy)
+    with pytest.raises(ClientError) as error:
+        send(router)
+    assert error.value.response["Error"]["Code"] == "ValidationException"
+    assert healthy.invocations == 0
+    assert router.targets[0].consecutive_failures == 0
+
+
+def test_no_target_serves_model():
+    router = app_router.BedrockRouter([app_router.RouteTarget("dedicated", "us-east-1", FakeBedrockRuntime(), model_id="anthropic.claude-v2")])
+    with pytest.raises(app_router.NoHealthyTargetError):
+        send(router)